@@ -1,58 +1,88 @@
 from src.func_data_diagnosis import *
 from src.func_data_engineering import *
 import pandas as pd
+import sys
 
 
 if __name__ == "__main__":
 
-    # read listing data
-    log_time("Read listing data")
+    # incremental mode: only compute and upsert the scrape months not in the feature store yet
+    incremental = '--incremental' in sys.argv
+    # stream mode: aggregate calendar files in chunks instead of holding all daily rows in memory
+    stream_calendar = '--stream-calendar' in sys.argv
+
     path = r"data/20"
     listing_name = "listings*.csv"
-    listings = read_data(path,listing_name, 'last_scraped', listing_data = True)
-    # put into one df
-    df_listing = pd.concat(listings, axis=0, ignore_index=True)
-
-    # read calendar data
-    log_time("Read calendar data")
     cal_name = "calendar*.csv"
-    calendars = read_data(path, cal_name, 'date')
-
-    # select dates in each calendar df
-    # for each monthly scrape, only keep the calendar data b/w the scraped date and the date of next scrape run
-    # todo:wrap this into a func
-    cal_months = []
-    num_cal = len(calendars)
-    for i in range(num_cal):
-        if i < num_cal - 1:
-            date_end = calendars[i + 1].SCRAPED_DATE[0]
-            df = calendars[i]
-            df = df[df.date < date_end]
-        else:
-            df = calendars[i]
-            date_start = pd.to_datetime(df.SCRAPED_DATE[0]).date()
-            date_end = date_start + relativedelta.relativedelta(months=1)
-            df = df[df.date < str(date_end)]
-        cal_months.append(df)
 
-    # put into one df
-    df_cal = pd.concat(cal_months, axis=0, ignore_index=True)
+    fs_tables = ["FS_LIST_MONTHLY", "FS_PRICE_MONTHLY", "FS_CAL_MONTHLY", "FS_BOOKED_MONTHLY"
+        , "FS_REVIEW_MONTHLY", "FS_LOCATION_MONTHLY", "FS_HOST_MONTHLY", "FS_TIME_MONTHLY"]
+
+    engine = connect_my_db("secrets/db_string")
 
-    # cleanse
-    log_time("Cleanse listing data")
-    df_listing = cleanse_data(df_listing)
-    log_time("Cleanse calendar data")
-    df_cal = cleanse_data(df_cal, list_data = False)
+    listing_files = None
+    cal_files = None
+    date_end_last = None
+    if incremental:
+        log_time("Detect new scrape months")
+        listing_dates = read_scrape_dates(path, listing_name, 'last_scraped')
+        listing_months = listing_dates.str[:7]
+        months_new = get_new_months(engine, fs_tables, listing_months)
+        if not months_new:
+            log_time("No new scrape months")
+            sys.exit()
+
+        # new months plus the 3 months before them for PRICE_LAG_3/PRICE_MA_3
+        months_window = get_lag_window(listing_months, months_new, num_lags=3)
+        listing_files = listing_dates[listing_months.isin(months_window)].index.tolist()
+
+        cal_dates = read_scrape_dates(path, cal_name, 'date')
+        # the calendar scraped before the window also covers the first days of the window's first month
+        cal_in_window = cal_dates.str[:7].isin(months_window)
+        cal_in_window |= cal_in_window.shift(-1, fill_value = False)
+        cal_files = cal_dates[cal_in_window].index.tolist()
+
+        # the last calendar read still ends at the next scrape run, if there is one
+        dates_after = cal_dates[cal_dates.str[:7] > months_window[-1]]
+        if not dates_after.empty:
+            date_end_last = dates_after.iloc[0]
+
+    # read and cleanse listing data, cleansed snapshots are cached by content
+    log_time("Read and cleanse listing data")
+    listings = read_cleansed(path, listing_name, 'last_scraped', listing_data = True, file_paths = listing_files)
+    # put into one df
+    df_listing = pd.concat(listings, axis=0, ignore_index=True)
 
-    # aggregate calendar data to monthly
-    log_time("Aggregate calendar data to monthly")
-    df_cal = agg_to_monthly(df_cal)
+    if stream_calendar:
+        # read, cleanse, cut and aggregate calendar data chunk by chunk
+        log_time("Stream and aggregate calendar data to monthly")
+        if not incremental:
+            cal_dates = read_scrape_dates(path, cal_name, 'date')
+            cal_files = cal_dates.index.tolist()
+        df_cal = agg_calendar_chunks(cal_dates[cal_files], date_end_last)
+    else:
+        # read and cleanse calendar data
+        log_time("Read and cleanse calendar data")
+        calendars = read_cleansed(path, cal_name, 'date', file_paths = cal_files)
+        calendars = sorted(calendars, key = lambda df: df.SCRAPED_DATE.iloc[0])
+
+        # select dates in each calendar df
+        # for each monthly scrape, only keep the calendar data b/w the scraped date and the date of next scrape run
+        cal_months = select_cal_dates(calendars, date_end_last, date_col = 'DATE')
+
+        # put into one df
+        df_cal = pd.concat(cal_months, axis=0, ignore_index=True)
+
+        # aggregate calendar data to monthly
+        log_time("Aggregate calendar data to monthly")
+        df_cal = agg_to_monthly(df_cal)
 
     # merge listing and aggregated calendar together
     df_listing['YEAR_MONTH'] = df_listing.SCRAPED_DATE.str[:7]
     df_data = df_cal.merge(df_listing, on=['ID','YEAR_MONTH'])
 
-    # todo: check and drop duplicate
+    # one row per ID and month, the primary key of the feature store, keep the latest scrape of a month
+    df_data = df_data.sort_values('SCRAPED_DATE', kind = 'mergesort').drop_duplicates(['ID', 'YEAR_MONTH'], keep = 'last')
     # todo: imputation?
 
     # feature store
@@ -80,43 +110,23 @@ if __name__ == "__main__":
     log_time('Feature engineering - time')
     df_time = fs_time(df_data, output_all=True)
 
-    # upload
-    engine = connect_my_db("secrets/db_string")
-
-    log_time("Upload to psql - listing")
-    upload_df(engine, df_list, "FS_LIST_MONTHLY")
-    log_time("Upload to psql done - listing")
-
-    log_time("Upload to psql - price")
-    upload_df(engine, df_price, "FS_PRICE_MONTHLY")
-    log_time("Upload to psql done - price")
-
-    log_time("Upload to psql - calendar")
-    upload_df(engine, df_calendar, "FS_CAL_MONTHLY")
-    log_time("Upload to psql done - calendar")
-
-    log_time("Upload to psql - booked")
-    upload_df(engine, df_booked, "FS_BOOKED_MONTHLY")
-    log_time("Upload to psql done - booked")
-
-    log_time("Upload to psql - review")
-    upload_df(engine, df_review, "FS_REVIEW_MONTHLY")
-    log_time("Upload to psql done - review")
-
-    log_time("Upload to psql - location")
-    upload_df(engine, df_location, "FS_LOCATION_MONTHLY")
-    log_time("Upload to psql done - location")
-
-    log_time("Upload to psql - host")
-    upload_df(engine, df_host, "FS_HOST_MONTHLY")
-    log_time("Upload to psql done - host")
-
-    log_time("Upload to psql - time")
-    upload_df(engine, df_time, "FS_TIME_MONTHLY")
-    log_time("Upload to psql done - time")
-
-
-
-
-
-
+    # upload, the tables are staged in parallel and published together
+    fs_dfs = {
+        "FS_LIST_MONTHLY": df_list
+        , "FS_PRICE_MONTHLY": df_price
+        , "FS_CAL_MONTHLY": df_calendar
+        , "FS_BOOKED_MONTHLY": df_booked
+        , "FS_REVIEW_MONTHLY": df_review
+        , "FS_LOCATION_MONTHLY": df_location
+        , "FS_HOST_MONTHLY": df_host
+        , "FS_TIME_MONTHLY": df_time
+    }
+
+    log_time("Upload to psql")
+    if incremental:
+        # the lag window months are only read for the lag features, upsert the new months
+        fs_dfs = {table_name: df[df.YEAR_MONTH.isin(months_new)] for table_name, df in fs_dfs.items()}
+        upload_dfs(engine, fs_dfs, months = months_new)
+    else:
+        upload_dfs(engine, fs_dfs)
+    log_time("Upload to psql done")
@@ -0,0 +1,7 @@
+from src.func_model_server import *
+
+
+if __name__ == "__main__":
+
+    # load the model once and serve predictions locally
+    serve_model(host='127.0.0.1', port=8050)
@@ -31,6 +31,9 @@ def cleanse_data(df, list_data = True):
             , 'MAXIMUM_NIGHTS_AVG_NTM': 'AVG_MAXIMUM_NIGHTS'
             , 'LAST_SCRAPED':'SCRAPED_DATE'
             }
+        # keep the snapshot scrape date from read_data, if there is one
+        if 'SCRAPED_DATE' in df_cp.columns:
+            df_cp = df_cp.drop('LAST_SCRAPED', axis=1)
         df_cp = df_cp.rename(columns=colname_map)
 
         # str columns lowercase
@@ -2,14 +2,22 @@
 
 from datetime import datetime
 import yaml
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text, bindparam
 import time
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from dateutil import relativedelta
 import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import io
+import re
+from inspect import getsource
 import os
+import shutil
 import sys
+from src.func_data_diagnosis import cleanse_data
 
 
 def log_time(msg):
@@ -27,117 +35,996 @@ def connect_my_db(secrets):
         uri = yaml.load(file, Loader = yaml.FullLoader)
     uri = uri["db_string"]
 
+    # a local parquet feature store, e.g. parquet://data/feature_store
+    if uri.startswith('parquet://'):
+        return ParquetStore(uri[len('parquet://'):])
+
     return create_engine(uri)
 
 
-def upload_df(engine, df, table_name):
+class ParquetStore:
+    """
+    A local feature store used in place of the database engine. Each table is a directory of parquet files,
+    Hive partitioned by month, e.g. root/FS_LIST_MONTHLY/YEAR_MONTH=2019-01/part-0.parquet
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, table_name):
+        return os.path.join(self.root, table_name)
+
+    def has_table(self, table_name):
+        return os.path.isdir(self.path(table_name))
+
+
+def write_parquet(store, df, table_name, partition_col = None):
+    """
+    Write df as a parquet dataset, replacing the files of the table
+    :param store: a ParquetStore
+    :param df: a data frame to be written
+    :param table_name: name of the table
+    :param partition_col: the month column to partition by, one file if None
+    :return: None
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    path = store.path(table_name)
+    shutil.rmtree(path, ignore_errors = True)
+    os.makedirs(path)
+
+    ds.write_dataset(pa.Table.from_pandas(df, preserve_index = False), path, format = 'parquet'
+                     , partitioning = [partition_col] if partition_col else None
+                     , partitioning_flavor = 'hive' if partition_col else None
+                     , existing_data_behavior = 'overwrite_or_ignore')
+
+
+def publish_parquet(store, table_name, months = None, date_col = 'YEAR_MONTH'):
+    """
+    Replace a table with its staging table, or only the month partitions if months are given
+    :param store: a ParquetStore
+    :param table_name: name of the table
+    :param months: the months to replace, the whole table if None
+    :param date_col: the month column
+    :return: None
+    """
+    staging = store.path(f'{table_name}_STAGING')
+    path = store.path(table_name)
+
+    if months is None or not store.has_table(table_name):
+        shutil.rmtree(path + '_OLD', ignore_errors = True)
+        if store.has_table(table_name):
+            os.replace(path, path + '_OLD')
+        os.replace(staging, path)
+        shutil.rmtree(path + '_OLD', ignore_errors = True)
+        return
+
+    # months with no rows staged are only dropped
+    for month in sorted(months):
+        partition = f'{date_col}={month}'
+        shutil.rmtree(os.path.join(path, partition), ignore_errors = True)
+        if os.path.isdir(os.path.join(staging, partition)):
+            os.replace(os.path.join(staging, partition), os.path.join(path, partition))
+    shutil.rmtree(staging)
+
+
+def read_parquet_table(store, table_name, columns = None, date_col = 'YEAR_MONTH', date_start = None, date_end = None):
+    """
+    Read a parquet table, only the columns asked for and only the month partitions b/w date_start and date_end
+    :param store: a ParquetStore
+    :param table_name: name of the table
+    :param columns: the columns to read, all if None
+    :param date_col: the month column
+    :param date_start: start date the data to retrieve, no lower bound if None
+    :param date_end: end date the data to retrieve, no upper bound if None
+    :return: a data frame, ID and date_col first
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(store.path(table_name), format = 'parquet', partitioning = 'hive')
+
+    date_filter = None
+    if date_start is not None:
+        date_filter = ds.field(date_col) >= str(date_start)
+    if date_end is not None:
+        date_end_filter = ds.field(date_col) <= str(date_end)
+        date_filter = date_end_filter if date_filter is None else date_filter & date_end_filter
+
+    df = dataset.to_table(columns = columns, filter = date_filter).to_pandas()
+
+    # the partition column comes last in the dataset
+    keys = [col for col in ['ID', date_col] if col in df.columns]
+    return df[keys + [col for col in df.columns if col not in keys]]
+
+
+def insert_df(conn, df, table_name, chunksize = 100000):
+    """
+    Bulk insert df into an existing table, in chunks. PostgreSQL streams each chunk as csv through
+    COPY FROM STDIN, other engines (e.g. SQLite) insert each chunk with executemany
+    :param conn: an open connection from sqlalchemy, inside a transaction
+    :param df: a data frame to be inserted
+    :param table_name: name of the table to be inserted into
+    :param chunksize: the number of rows sent at a time
+    :return: None
+    """
+    if conn.dialect.name != 'postgresql':
+        df.to_sql(table_name, conn, if_exists = 'append', index = False, chunksize = chunksize)
+        return
+
+    cols = ', '.join(f'"{col}"' for col in df.columns)
+    query = f'COPY "{table_name}" ({cols}) FROM STDIN WITH (FORMAT csv)'
+
+    cursor = conn.connection.cursor()
+    for start in range(0, len(df), chunksize):
+        buffer = io.StringIO()
+        df.iloc[start:start + chunksize].to_csv(buffer, index = False, header = False)
+        buffer.seek(0)
+        cursor.copy_expert(query, buffer)
+    cursor.close()
+
+
+def partition_name(table_name, month):
+    """
+    Name of the partition of a table for a month, e.g. FS_LIST_MONTHLY_2019_01
+    :param table_name: name of the partitioned table
+    :param month: the month, YYYY-MM
+    :return: the name of the partition
+    """
+    return f'{table_name}_{str(month).replace("-", "_")}'
+
+
+def get_partitions(conn, table_name):
+    """
+    Read the partitions of a PostgreSQL table
+    :param conn: an open connection from sqlalchemy
+    :param table_name: name of the table
+    :return: a list of partition names, empty if the table is not partitioned
+    """
+    query = text('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                 'JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :table_name')
+
+    return [row[0] for row in conn.execute(query, {'table_name': table_name})]
+
+
+def rename_partition(conn, partition, new_name):
     """
-    upload the table to PostgreSQL database
+    Rename a PostgreSQL partition and its primary key index, which PostgreSQL names <partition>_pkey
+    when the partition is created, so the index name follows the partition
+    :param conn: an open connection from sqlalchemy, inside a transaction
+    :param partition: name of the partition
+    :param new_name: the new name of the partition
+    :return: None
+    """
+    query = text('SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                 'JOIN pg_class t ON t.oid = i.indrelid WHERE t.relname = :table_name AND i.indisprimary')
+    pk_index = conn.execute(query, {'table_name': partition}).scalar()
+
+    conn.execute(text(f'ALTER TABLE "{partition}" RENAME TO "{new_name}"'))
+    if pk_index is not None:
+        conn.execute(text(f'ALTER INDEX "{pk_index}" RENAME TO "{new_name}_pkey"'))
+
+
+def stage_df(engine, df, table_name, chunksize = 100000, keys = None, partition_col = None):
+    """
+    Bulk load df into the staging table of a table, in its own transaction. On PostgreSQL the staging table
+    is list partitioned by partition_col, one partition per month
     :param engine: the connection engine from func connect_my_db
     :param df: a data frame to be uploaded
     :param table_name: name of the table to be uploaded to
-    :return: time it takes
+    :param chunksize: the number of rows sent at a time
+    :param keys: the primary key columns, no primary key if None
+    :param partition_col: the month column to partition by, no partitions if None
+    :return: a dict of table, rows, seconds and rows per second
     """
     tik = time.time()
 
-    df.to_sql(table_name, engine, if_exists = 'replace', index = False)
+    staging = f'{table_name}_STAGING'
+    if isinstance(engine, ParquetStore):
+        if (keys is not None) and df.duplicated(keys).any():
+            raise ValueError(f'Duplicate primary key {keys} in {table_name}')
+        write_parquet(engine, df, staging, partition_col)
+        tok = time.time()
+
+        return {'TABLE': table_name, 'ROWS': df.shape[0], 'SECONDS': round(tok - tik, 2)
+            , 'ROWS_PER_SEC': round(df.shape[0] / max(tok - tik, 1e-9))}
+
+    with engine.begin() as conn:
+        partitioned = (partition_col is not None) and (conn.dialect.name == 'postgresql')
+
+        conn.execute(text(f'DROP TABLE IF EXISTS "{staging}"'))
+        query = pd.io.sql.get_schema(df, staging, keys = keys, con = conn).rstrip()
+        if partitioned:
+            query += f' PARTITION BY LIST ("{partition_col}")'
+        conn.execute(text(query))
+
+        if partitioned:
+            for month in sorted(df[partition_col].astype(str).unique()):
+                value = month.replace("'", "''")
+                conn.execute(text(f'CREATE TABLE "{partition_name(staging, month)}" '
+                                  f'PARTITION OF "{staging}" FOR VALUES IN (\'{value}\')'))
+
+        insert_df(conn, df, staging, chunksize)
     tok = time.time()
 
-    return tok - tik
+    return {'TABLE': table_name, 'ROWS': df.shape[0], 'SECONDS': round(tok - tik, 2)
+        , 'ROWS_PER_SEC': round(df.shape[0] / max(tok - tik, 1e-9))}
+
+
+def publish_staged(conn, table_name, months = None, date_col = 'YEAR_MONTH', partitioned = False):
+    """
+    Replace a table with its staging table, or only the months of the staging table if months are given.
+    For partitioned tables, PostgreSQL swaps in the month partitions and other engines (e.g. SQLite)
+    index date_col instead
+    :param conn: an open connection from sqlalchemy, inside a transaction
+    :param table_name: name of the table
+    :param months: the months to replace, the whole table if None
+    :param date_col: the month column
+    :param partitioned: if the table is partitioned by date_col, see stage_df
+    :return: None
+    """
+    staging = f'{table_name}_STAGING'
+    postgres = conn.dialect.name == 'postgresql'
+
+    if months is None or not inspect(conn).has_table(table_name):
+        conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+        conn.execute(text(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"'))
+        if postgres:
+            # free the staging names for the next upload
+            conn.execute(text(f'ALTER INDEX IF EXISTS "{staging}_pk" RENAME TO "{table_name}_pk"'))
+            for partition in get_partitions(conn, table_name):
+                rename_partition(conn, partition, table_name + partition[len(staging):])
+        elif partitioned:
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS "IX_{table_name}_{date_col}" '
+                              f'ON "{table_name}" ("{date_col}")'))
+        return
+
+    if postgres and partitioned and get_partitions(conn, table_name):
+        # swap the month partitions, months with no rows staged are only dropped
+        staged = get_partitions(conn, staging)
+        for month in sorted(months):
+            value = str(month).replace("'", "''")
+            conn.execute(text(f'DROP TABLE IF EXISTS "{partition_name(table_name, month)}"'))
+            if partition_name(staging, month) in staged:
+                conn.execute(text(f'ALTER TABLE "{staging}" DETACH PARTITION "{partition_name(staging, month)}"'))
+                rename_partition(conn, partition_name(staging, month), partition_name(table_name, month))
+                conn.execute(text(f'ALTER TABLE "{table_name}" ATTACH PARTITION "{partition_name(table_name, month)}" '
+                                  f'FOR VALUES IN (\'{value}\')'))
+        conn.execute(text(f'DROP TABLE "{staging}"'))
+        return
+
+    query = text(f'DELETE FROM "{table_name}" WHERE "{date_col}" IN :months').bindparams(
+        bindparam('months', expanding = True))
+    conn.execute(query, {'months': sorted(months)})
+
+    cols = ', '.join(f'"{col["name"]}"' for col in inspect(conn).get_columns(staging))
+    conn.execute(text(f'INSERT INTO "{table_name}" ({cols}) SELECT {cols} FROM "{staging}"'))
+    conn.execute(text(f'DROP TABLE "{staging}"'))
+
+
+def upload_df(engine, df, table_name, chunksize = 100000, keys = None, partition_col = None):
+    """
+    upload the table to PostgreSQL database. The rows are bulk loaded into a staging table first,
+    and the staging table then replaces the table in one transaction
+    :param engine: the connection engine from func connect_my_db
+    :param df: a data frame to be uploaded
+    :param table_name: name of the table to be uploaded to
+    :param chunksize: the number of rows sent at a time
+    :param keys: the primary key columns, no primary key if None
+    :param partition_col: the month column to partition by, no partitions if None
+    :return: time it takes and rows per second
+    """
+    tik = time.time()
+
+    stage_df(engine, df, table_name, chunksize, keys, partition_col)
+    if isinstance(engine, ParquetStore):
+        publish_parquet(engine, table_name)
+    else:
+        with engine.begin() as conn:
+            publish_staged(conn, table_name, date_col = partition_col, partitioned = partition_col is not None)
+    tok = time.time()
+
+    return tok - tik, len(df) / max(tok - tik, 1e-9)
+
+
+def upload_dfs(engine, dfs, months = None, date_col = 'YEAR_MONTH', num_workers = 4, chunksize = 100000
+               , keys = ['ID', 'YEAR_MONTH'], partitioned = True):
+    """
+    Upload multiple tables in parallel and publish all or none of them. Each table is staged over its own
+    connection, at most num_workers at a time, then all the staging tables are swapped in in one transaction.
+    If any table fails to stage, the staging tables are dropped and the tables are left as they were
+    :param engine: the connection engine or the ParquetStore from func connect_my_db
+    :param dfs: a dict of table name and the data frame to be uploaded to it
+    :param months: only replace these months of the tables, replace the whole tables if None
+    :param date_col: the month column
+    :param num_workers: the max number of tables staged at a time, 1 for SQLite which takes one writer at a time
+    :param chunksize: the number of rows sent at a time
+    :param keys: the primary key columns, no primary key if None
+    :param partitioned: partition the tables by date_col, see stage_df
+    :return: a df of rows, seconds and rows per second per table
+    """
+    if (not isinstance(engine, ParquetStore)) and (engine.dialect.name == 'sqlite'):
+        num_workers = 1
+    num_workers = max(min(num_workers, len(dfs)), 1)
+    partition_col = date_col if partitioned else None
+
+    try:
+        with ThreadPoolExecutor(max_workers = num_workers) as executor:
+            futures = [executor.submit(stage_df, engine, df, table_name, chunksize, keys, partition_col)
+                       for table_name, df in dfs.items()]
+            results = [future.result() for future in futures]
+    except Exception:
+        if isinstance(engine, ParquetStore):
+            for table_name in dfs:
+                shutil.rmtree(engine.path(f'{table_name}_STAGING'), ignore_errors = True)
+        else:
+            with engine.begin() as conn:
+                for table_name in dfs:
+                    conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}_STAGING"'))
+        raise
+
+    df_stats = pd.DataFrame(results, columns = ['TABLE', 'ROWS', 'SECONDS', 'ROWS_PER_SEC'])
+    for stats in df_stats.itertuples():
+        log_time(f'Staged {stats.TABLE}: {stats.ROWS} rows, {stats.SECONDS} s, {stats.ROWS_PER_SEC} rows/s')
+
+    if isinstance(engine, ParquetStore):
+        for table_name in dfs:
+            publish_parquet(engine, table_name, months, date_col)
+    else:
+        with engine.begin() as conn:
+            for table_name in dfs:
+                publish_staged(conn, table_name, months, date_col, partitioned)
+
+    return df_stats
+
+
+def read_months(engine, table_name, date_col = 'YEAR_MONTH'):
+    """
+    Read the months already in a table
+    :param engine: the connection engine from sqlalchemy
+    :param table_name: name of the table
+    :param date_col: the month column
+    :return: a set of months, empty if the table does not exist
+    """
+    if isinstance(engine, ParquetStore):
+        if not engine.has_table(table_name):
+            return set()
+        return {name.split('=', 1)[1] for name in os.listdir(engine.path(table_name))
+                if name.startswith(f'{date_col}=')}
+
+    if not inspect(engine).has_table(table_name):
+        return set()
+
+    query = f'SELECT DISTINCT "{date_col}" FROM "{table_name}"'
+    df = pd.read_sql(query, engine)
+
+    return set(df[date_col].astype(str))
+
 
 def read_table(engine, table_name, date_col = 'YEAR_MONTH', date_start = None, date_end = None):
     """
     Read the table from PostgreSQL
     :param engine: the connection engine from sqlalchemy
     :param table_name: name of the table
-    :param date_start: start date the data to retrieve
-    :param date_end: end date the data to retrieve
+    :param date_col: the month column
+    :param date_start: start date the data to retrieve, no lower bound if None
+    :param date_end: end date the data to retrieve, no upper bound if None
     :return: the data frame read from the PostgreSQL
     """
-    if None not in (date_start, date_end):
-        query = 'SELECT * FROM ' + f'"{table_name}" WHERE "{date_col}" between '+ f"'{date_start}' and '{date_end}'"
-    else:
-        query = 'SELECT * FROM ' + f'"{table_name}"'
+    if isinstance(engine, ParquetStore):
+        return read_parquet_table(engine, table_name, date_col = date_col, date_start = date_start, date_end = date_end)
 
-    df = pd.read_sql(query, engine)
+    where, params = date_where(date_col, date_start, date_end)
+    query = f'SELECT * FROM "{table_name}"{where}'
+
+    df = pd.read_sql(text(query), engine, params = params)
     return df
 
-def read_tables(engine, table_names=["FS_LIST_MONTHLY","FS_CAL_MONTHLY"
-    ,"FS_HOST_MONTHLY",'FS_REVIEW_MONTHLY'
-    ,"FS_BOOKED_MONTHLY","FS_LOCATION_MONTHLY"
-    ,"FS_TIME_MONTHLY","FS_PRICE_MONTHLY"], date_start = None, date_end = None):
+
+def date_where(date_col, date_start = None, date_end = None):
+    """
+    Build the WHERE clause of a date filter, either bound can be None
+    :param date_col: the month column
+    :param date_start: start date the data to retrieve, no lower bound if None
+    :param date_end: end date the data to retrieve, no upper bound if None
+    :return: the WHERE clause, empty if there is no bound, and its params
+    """
+    conditions = []
+    params = {}
+    if date_start is not None:
+        conditions.append(f'"{date_col}" >= :date_start')
+        params['date_start'] = date_start
+    if date_end is not None:
+        conditions.append(f'"{date_col}" <= :date_end')
+        params['date_end'] = date_end
+
+    if not conditions:
+        return '', params
+    return ' WHERE ' + ' AND '.join(conditions), params
+
+
+FS_TABLES = ["FS_LIST_MONTHLY", "FS_CAL_MONTHLY", "FS_HOST_MONTHLY", "FS_REVIEW_MONTHLY"
+    , "FS_BOOKED_MONTHLY", "FS_LOCATION_MONTHLY", "FS_TIME_MONTHLY", "FS_PRICE_MONTHLY"]
+
+
+def compact_features(df, keys = ['ID', 'YEAR_MONTH']):
+    """
+    Shrink the dtypes of a feature df: floats to float32, ints to the smallest int and str columns to categoricals
+    :param df: a feature data frame
+    :param keys: the key columns, kept as they are
+    :return: a data frame with the same columns and values
+    """
+    # make a copy
+    df_cp = df.copy()
+
+    for col in df_cp.columns.difference(keys):
+        if pd.api.types.is_float_dtype(df_cp[col]):
+            df_cp[col] = df_cp[col].astype('float32')
+        elif pd.api.types.is_integer_dtype(df_cp[col]):
+            df_cp[col] = pd.to_numeric(df_cp[col], downcast = 'integer')
+        elif df_cp[col].dtype == object:
+            df_cp[col] = df_cp[col].astype('category')
+
+    return df_cp
+
+
+def concat_compact(chunks):
+    """
+    Put compact chunks into one df, with the categories of each categorical column unioned across chunks
+    :param chunks: a list of data frames from compact_features
+    :return: a data frame
+    """
+    chunks = list(chunks)
+    for col in chunks[0].columns:
+        if all(isinstance(chunk[col].dtype, pd.CategoricalDtype) for chunk in chunks):
+            categories = pd.api.types.union_categoricals([chunk[col] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+
+    return pd.concat(chunks, ignore_index = True)
+
+
+def stack_sparse(df_num, ohe_cols):
+    """
+    Stack the numerical columns and the one-hot encoded columns into one CSR matrix for XGBoost.
+    XGBoost takes the values not stored in a sparse matrix as missing, so the numerical columns
+    keep their zeros as stored values and only the one-hot columns are sparse
+    :param df_num: a data frame of numerical columns
+    :param ohe_cols: the one-hot encoded columns, a dense array or a sparse matrix
+    :return: a float32 CSR matrix, the numerical columns first
+    """
+    num = df_num.to_numpy(dtype = np.float32)
+    num_rows, num_cols = num.shape
+    num = sparse.csr_matrix((num.ravel(), np.tile(np.arange(num_cols), num_rows)
+                             , np.arange(0, num_rows * num_cols + 1, num_cols)), shape = num.shape)
+
+    return sparse.hstack([num, sparse.csr_matrix(ohe_cols, dtype = np.float32)], format = 'csr')
+
+
+def build_vocab(df, cols):
+    """
+    Take the training data and build the vocabulary of the categorical columns,
+    the sorted categories of each column, so each category has a stable integer code
+    :param df: a data frame with the categorical columns
+    :param cols: the categorical columns
+    :return: a dict of column and its list of categories
+    """
+    return {col: sorted(df[col].dropna().astype(str).unique()) for col in cols}
+
+
+def apply_vocab(df, vocab):
+    """
+    Turn the categorical columns into categoricals with the categories of the vocabulary,
+    for XGBoost's native categorical support. Categories not in the vocabulary become missing
+    :param df: a data frame with the categorical columns
+    :param vocab: the output of build_vocab
+    :return: a data frame with the same columns
+    """
+    # make a copy
+    df_cp = df.copy()
+
+    for col, categories in vocab.items():
+        values = df_cp[col]
+        df_cp[col] = pd.Categorical(values.astype(str).where(values.notna()), categories = categories)
+
+    return df_cp
+
+
+def check_columns(columns, found, keys):
+    """
+    Raise a ValueError naming the feature columns asked for but in none of the tables,
+    or if there is no feature column to read at all
+    :param columns: the feature columns asked for, all if None
+    :param found: the columns found in the tables
+    :param keys: the key columns, always read
+    :return: None
+    """
+    missing = [] if columns is None else [col for col in columns if (col not in found) and (col not in keys)]
+    if missing:
+        raise ValueError(f'Columns not in the feature tables: {missing}')
+    if not found:
+        raise ValueError('No feature columns to read')
+
+
+def read_features(engine, table_names = FS_TABLES, columns = None, date_col = 'YEAR_MONTH'
+                  , date_start = None, date_end = None, how = 'outer', chunksize = 100000, compact = True):
+    """
+    Read the feature tables with one join on the database, only the columns asked for and only the months
+    b/w date_start and date_end, streamed in chunks
+    :param engine: the connection engine from sqlalchemy, or a ParquetStore
+    :param table_names: names of the tables
+    :param columns: the feature columns to read, all if None. ID and date_col are always read,
+    tables with none of the columns are not read. A ValueError is raised for the columns in none of the tables
+    :param date_col: the month column
+    :param date_start: start date the data to retrieve, no lower bound if None
+    :param date_end: end date the data to retrieve, no upper bound if None
+    :param how: 'outer' to keep the rows in any of the tables, 'inner' to keep the rows in all of them
+    :param chunksize: the number of rows fetched at a time
+    :param compact: shrink the dtypes of each chunk, see compact_features
+    :return: a df with one row per ID and month
+    """
+    keys = ['ID', date_col]
+
+    if isinstance(engine, ParquetStore):
+        return read_parquet_features(engine, table_names, columns, date_col, date_start, date_end, how, compact)
+
+    # column projection
+    insp = inspect(engine)
+    table_cols = {}
+    for table in table_names:
+        cols = [col['name'] for col in insp.get_columns(table) if col['name'] not in keys]
+        if columns is not None:
+            cols = [col for col in cols if col in columns]
+        if cols:
+            table_cols[table] = cols
+    check_columns(columns, [col for cols in table_cols.values() for col in cols], keys)
+
+    # date filter
+    where, params = date_where(date_col, date_start, date_end)
+
+    aliases = {table: f't{i}' for i, table in enumerate(table_cols)}
+    selects = [f'{aliases[table]}."{col}"' for table, cols in table_cols.items() for col in cols]
+
+    if how == 'outer':
+        # the keys in any of the tables, each table joined to them
+        key_cols = ', '.join(f'"{key}"' for key in keys)
+        union = ' UNION '.join(f'SELECT {key_cols} FROM "{table}"{where}' for table in table_cols)
+        joins = ' '.join(f'LEFT JOIN "{table}" {alias} ON '
+                         + ' AND '.join(f'{alias}."{key}" = k."{key}"' for key in keys)
+                         for table, alias in aliases.items())
+        query = (f'SELECT ' + ', '.join([f'k."{key}"' for key in keys] + selects)
+                 + f' FROM ({union}) k {joins}')
+    elif how == 'inner':
+        first = next(iter(aliases.values()))
+        joins = ' '.join(f'JOIN "{table}" {alias} ON '
+                         + ' AND '.join(f'{alias}."{key}" = {first}."{key}"' for key in keys)
+                         for table, alias in list(aliases.items())[1:])
+        query = (f'SELECT ' + ', '.join([f'{first}."{key}"' for key in keys] + selects)
+                 + f' FROM "{next(iter(aliases))}" {first} {joins}'
+                 + where.replace(f'"{date_col}"', f'{first}."{date_col}"'))
+    else:
+        sys.exit(f'Unknown join: {how}')
+    query += ' ORDER BY 1, 2'
+
+    # stream the rows with a server side cursor where the database has one
+    with engine.connect().execution_options(stream_results = True) as conn:
+        chunks = [compact_features(chunk, keys) if compact else chunk
+                  for chunk in pd.read_sql(text(query), conn, params = params, chunksize = chunksize)]
+
+    if compact:
+        return concat_compact(chunks)
+    return pd.concat(chunks, ignore_index = True)
+
+
+def read_parquet_features(store, table_names = FS_TABLES, columns = None, date_col = 'YEAR_MONTH'
+                          , date_start = None, date_end = None, how = 'outer', compact = True):
     """
-    read multiple tables and combine into one df
-    :param engine:
-    :param table_names:
-    :param date_start:
-    :param date_end:
-    :return:
+    Read the feature tables of a ParquetStore, with the columns and month partitions pushed down to
+    each dataset, and join them on ID and date_col. See read_features
+    :return: a df with one row per ID and month
     """
-    # initialize
-    df_all = pd.DataFrame(columns=['ID','YEAR_MONTH'])
+    import pyarrow.dataset as ds
 
+    keys = ['ID', date_col]
+    if how not in ('outer', 'inner'):
+        sys.exit(f'Unknown join: {how}')
+
+    table_cols = {}
     for table in table_names:
-        df = read_table(engine, table, date_start, date_end)
-        df_all = df_all.merge(df, on = ['ID','YEAR_MONTH'],how='outer')
+        names = ds.dataset(store.path(table), format = 'parquet', partitioning = 'hive').schema.names
+        cols = [col for col in names if (col not in keys) and ((columns is None) or (col in columns))]
+        if cols:
+            table_cols[table] = cols
+    check_columns(columns, [col for cols in table_cols.values() for col in cols], keys)
+
+    df_all = None
+    for table, cols in table_cols.items():
+        df = read_parquet_table(store, table, keys + cols, date_col, date_start, date_end)
+        df_all = df if df_all is None else df_all.merge(df, on = keys, how = how)
+
+    df_all = df_all.sort_values(by = keys).reset_index(drop = True)
 
+    if compact:
+        return compact_features(df_all, keys)
     return df_all
 
 
-def read_data(path, file_names, col_scrape_date, listing_data = False):
+def read_tables(engine, table_names = FS_TABLES, date_start = None, date_end = None):
     """
-    Read multiple csv files and output a list of  dataframe
+    read multiple tables and combine into one df, see read_features
+    :param engine: the connection engine from sqlalchemy
+    :param table_names: names of the tables
+    :param date_start: start date the data to retrieve
+    :param date_end: end date the data to retrieve
+    :return: a df of all the columns of the tables, outer joined on ID and YEAR_MONTH
+    """
+    return read_features(engine, table_names, date_start = date_start, date_end = date_end, compact = False)
+
+
+def read_scrape_dates(path, file_names, col_scrape_date, chunksize = 1000000):
+    """
+    Read only the scrape date column of multiple csv files, in chunks
     :param path: file path
     :param file_names: file names in regex
-    :param col_names: columns to output
     :param col_scrape_date: the column to be used to create scrape_date
-    :return: a list of df
+    :param chunksize: the number of rows read at a time
+    :return: a series of scrape dates indexed by file path, sorted by date
     """
     file_paths = glob.glob(os.path.join(path, file_names))
-    list_df = []
 
+    scrape_dates = {}
     for file in file_paths:
+        chunks = pd.read_csv(file, usecols = [col_scrape_date], dtype = str, chunksize = chunksize)
+        scrape_dates[file] = min(chunk[col_scrape_date].min() for chunk in chunks)
+
+    return pd.Series(scrape_dates, dtype = object).sort_values()
+
+
+def get_new_months(engine, table_names, months):
+    """
+    Find the scrape months that are not in all the tables yet
+    :param engine: the connection engine from sqlalchemy
+    :param table_names: names of the feature tables
+    :param months: the scrape months available
+    :return: a sorted list of new months
+    """
+    months_done = set.intersection(*[read_months(engine, table) for table in table_names])
+
+    return sorted(set(months) - months_done)
+
+
+def get_lag_window(months, months_new, num_lags = 3):
+    """
+    Add the months needed for the lag features to the new months
+    :param months: all the scrape months available
+    :param months_new: the new months to compute features for
+    :param num_lags: the number of previous months the lag features need
+    :return: a sorted list of months to read
+    """
+    months = sorted(set(months))
+    months_window = set()
+
+    for month in months_new:
+        i = months.index(month)
+        months_window.update(months[max(i - num_lags, 0):i + 1])
+
+    return sorted(months_window)
+
+
+def select_cal_dates(calendars, date_end_last = None, date_col = 'date'):
+    """
+    For each monthly scrape, only keep the calendar data b/w the scraped date and the date of next scrape run
+    :param calendars: a list of calendar dfs, sorted by scraped date
+    :param date_end_last: the end date for the last calendar, one month after its scraped date if None
+    :param date_col: the date column, DATE once cleansed
+    :return: a list of calendar dfs
+    """
+    cal_months = []
+    num_cal = len(calendars)
+    for i in range(num_cal):
+        df = calendars[i]
+        if i < num_cal - 1:
+            date_end = calendars[i + 1].SCRAPED_DATE.iloc[0]
+        elif date_end_last is not None:
+            date_end = date_end_last
+        else:
+            date_start = pd.to_datetime(df.SCRAPED_DATE.iloc[0]).date()
+            date_end = str(date_start + relativedelta.relativedelta(months=1))
+        dates = df[date_col]
+        if isinstance(dates.dtype, pd.CategoricalDtype):
+            # compare the categories once, then map them to the rows
+            keep = np.asarray(dates.cat.categories.astype(str) < str(date_end))[dates.cat.codes]
+            keep = keep & (dates.cat.codes >= 0).to_numpy()
+        else:
+            keep = dates < str(date_end)
+        df = df[keep]
+        cal_months.append(df)
+
+    return cal_months
+
+
+# columns read from the listing snapshots
+LISTING_COLS = [
+    # listing
+    'id', 'last_scraped', 'property_type', 'room_type', 'accommodates'
+    , 'bathrooms', 'bedrooms', 'beds', 'bed_type', 'amenities', 'square_feet'
+    , 'instant_bookable', 'is_business_travel_ready', 'cancellation_policy'
+    , 'require_guest_profile_picture', 'require_guest_phone_verification'
+    , 'guests_included'
+    # calendar
+    , 'minimum_nights', 'maximum_nights', 'minimum_minimum_nights', 'maximum_minimum_nights'
+    , 'minimum_maximum_nights', 'maximum_maximum_nights', 'minimum_nights_avg_ntm'
+    , 'maximum_nights_avg_ntm', 'calendar_updated', 'has_availability', 'availability_30'
+    , 'availability_60', 'availability_90', 'availability_365', 'calendar_last_scraped'
+    # reviews
+    , 'number_of_reviews', 'number_of_reviews_ltm', 'first_review', 'last_review'
+    , 'review_scores_rating', 'review_scores_accuracy', 'review_scores_cleanliness'
+    , 'review_scores_checkin', 'review_scores_communication', 'review_scores_location'
+    , 'review_scores_value', 'reviews_per_month'
+    # prices
+    , 'price', 'weekly_price', 'monthly_price', 'security_deposit', 'cleaning_fee'
+    , 'extra_people'
+    # location
+    , 'street', 'neighbourhood_cleansed', 'city', 'state'
+    , 'zipcode', 'market', 'smart_location', 'country', 'latitude', 'longitude'
+    , 'is_location_exact'
+    # host
+    , 'host_id', 'host_since', 'host_neighbourhood', 'host_response_time'
+    , 'host_response_rate', 'host_acceptance_rate', 'host_is_superhost'
+    , 'calculated_host_listings_count', 'calculated_host_listings_count_entire_homes'
+    , 'calculated_host_listings_count_private_rooms'
+    , 'calculated_host_listings_count_shared_rooms'
+    , 'host_verifications', 'host_has_profile_pic', 'host_identity_verified'
+]
+
+# explicit dtypes, so the types are not guessed per chunk; the other listing columns are str
+LISTING_DTYPES = {col: 'int64' for col in [
+    'id', 'accommodates', 'guests_included', 'minimum_nights', 'maximum_nights'
+    , 'availability_30', 'availability_60', 'availability_90', 'availability_365'
+    , 'number_of_reviews', 'number_of_reviews_ltm'
+    , 'calculated_host_listings_count', 'calculated_host_listings_count_entire_homes'
+    , 'calculated_host_listings_count_private_rooms'
+    , 'calculated_host_listings_count_shared_rooms']}
+LISTING_DTYPES.update({col: 'float64' for col in [
+    'bathrooms', 'bedrooms', 'beds', 'square_feet'
+    , 'minimum_minimum_nights', 'maximum_minimum_nights', 'minimum_maximum_nights'
+    , 'maximum_maximum_nights', 'minimum_nights_avg_ntm', 'maximum_nights_avg_ntm'
+    , 'review_scores_rating', 'review_scores_accuracy', 'review_scores_cleanliness'
+    , 'review_scores_checkin', 'review_scores_communication', 'review_scores_location'
+    , 'review_scores_value', 'reviews_per_month', 'latitude', 'longitude', 'host_id']})
+LISTING_DTYPES.update({col: 'str' for col in LISTING_COLS if col not in LISTING_DTYPES})
+
+# columns read from the calendar snapshots
+CALENDAR_COLS = ['listing_id', 'date', 'available', 'price', 'adjusted_price', 'minimum_nights', 'maximum_nights']
+
+CALENDAR_DTYPES = {'listing_id': 'int64', 'date': 'str', 'available': 'str', 'price': 'str'
+    , 'adjusted_price': 'str', 'minimum_nights': 'float64', 'maximum_nights': 'float64'}
+
+
+def read_csv_file(file, col_scrape_date, listing_data = False, use_pyarrow = False):
+    """
+    Read one csv file with only the columns needed
+    :param file: path of the csv file
+    :param col_scrape_date: the column to be used to create scrape_date
+    :param listing_data: specify if the file is listing data or calendar data
+    :param use_pyarrow: parse the csv with pyarrow instead of the C parser
+    :return: the df and a dict of FILE, ROWS, BYTES and SECONDS
+    """
+    tik = time.time()
+
+    if listing_data:
+        cols, dtypes = LISTING_COLS, LISTING_DTYPES
+    else:
+        cols, dtypes = CALENDAR_COLS, CALENDAR_DTYPES
+
+    if use_pyarrow:
+        # optional dependency
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+
+        column_types = {col: pa.string() if dtype == 'str' else pa.from_numpy_dtype(np.dtype(dtype))
+                        for col, dtype in dtypes.items()}
+        options = pa_csv.ConvertOptions(include_columns=cols, column_types=column_types, strings_can_be_null=True)
+        df = pa_csv.read_csv(file, convert_options=options).to_pandas()
+        # missing str values as nan instead of None, the same as the C parser
+        cols_str = df.select_dtypes(include='object').columns
+        df[cols_str] = df[cols_str].where(df[cols_str].notna(), np.nan)
+    else:
+        df = pd.read_csv(file, header=0, usecols=cols, dtype=dtypes)
+    # keep the column order of cols
+    df = df[cols]
+    df['SCRAPED_DATE'] = df[col_scrape_date].min()
+    tok = time.time()
+
+    stats = {'FILE': file, 'ROWS': df.shape[0], 'BYTES': os.path.getsize(file), 'SECONDS': round(tok - tik, 2)}
+
+    return df, stats
+
+
+def read_data(path, file_names, col_scrape_date, listing_data = False, file_paths = None
+              , num_workers = None, use_pyarrow = False, out_stats = False):
+    """
+    Read multiple csv files in parallel and output a list of  dataframe
+    :param path: file path
+    :param file_names: file names in regex
+    :param col_scrape_date: the column to be used to create scrape_date
+    :param listing_data: specify if the files are listing data or calendar data
+    :param file_paths: optional, only read these files instead of all the files matched
+    :param num_workers: the number of processes, one per cpu if None, 1 to read in this process
+    :param use_pyarrow: parse the csv files with pyarrow instead of the C parser
+    :param out_stats: if True, also return a df of rows, bytes and seconds per file
+    :return: a list of df, in the order of the files
+    """
+    if file_paths is None:
+        file_paths = glob.glob(os.path.join(path, file_names))
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(min(num_workers, len(file_paths)), 1)
+
+    args = [(file, col_scrape_date, listing_data, use_pyarrow) for file in file_paths]
+    if num_workers == 1:
+        results = [read_csv_file(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers = num_workers) as executor:
+            results = list(executor.map(read_csv_file, *zip(*args)))
+
+    list_df = [df for df, stats in results]
+    df_stats = pd.DataFrame([stats for df, stats in results], columns = ['FILE', 'ROWS', 'BYTES', 'SECONDS'])
+
+    for stats in df_stats.itertuples():
+        log_time(f'Read {stats.FILE}: {stats.ROWS} rows, {stats.BYTES / 1e6:.1f} MB, {stats.SECONDS} s')
+
+    if out_stats:
+        return list_df, df_stats
+    else:
+        return list_df
+
+# 0/1 flags of the cleansed snapshots, kept as int8 in the cache
+FLAG_COLS = ['INSTANT_BOOKABLE', 'REQUIRE_GUEST_PROFILE_PICTURE', 'REQUIRE_GUEST_PHONE_VERIFICATION'
+    , 'HOST_IS_SUPERHOST', 'HOST_HAS_PROFILE_PIC', 'HOST_IDENTITY_VERIFIED'
+    , 'IS_LOCATION_EXACT', 'IS_BUSINESS_TRAVEL_READY', 'BOOKED']
+
+
+def compact_dtypes(df, max_cate_ratio = 0.5):
+    """
+    Take a cleansed snapshot and shrink its dtypes: 0/1 flags to int8 (float32 if they have NaN)
+    and repeated str columns to categoricals. Prices stay float64, as float32 would not keep the cents,
+    e.g. 123.45 would be read back from the cache as 123.4499969
+    :param df: a cleansed data frame
+    :param max_cate_ratio: the max ratio of unique values to rows for a str column to become a categorical
+    :return: a data frame with the same columns and values
+    """
+    # make a copy
+    df_cp = df.copy()
+
+    for col in df_cp.columns:
+        if col in FLAG_COLS:
+            df_cp[col] = pd.to_numeric(df_cp[col])
+            df_cp[col] = df_cp[col].astype('int8' if df_cp[col].notna().all() else 'float32')
+        elif (df_cp[col].dtype == object) and (pd.api.types.infer_dtype(df_cp[col], skipna=True) == 'string'):
+            if df_cp[col].nunique() <= max_cate_ratio * df_cp.shape[0]:
+                df_cp[col] = df_cp[col].astype('category')
+
+    return df_cp
+
+
+def get_cache_key(file, listing_data = False):
+    """
+    Key a cleansed snapshot by the content of the raw file and the code that reads and cleanses it,
+    so the cache is invalid once the file, the columns or dtypes read, read_csv_file, cleanse_data
+    or compact_dtypes change
+    :param file: path of the raw csv file
+    :param listing_data: specify if the file is listing data or calendar data
+    :return: a hex digest
+    """
+    key = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            key.update(chunk)
+
+    cols = LISTING_COLS if listing_data else CALENDAR_COLS
+    dtypes = LISTING_DTYPES if listing_data else CALENDAR_DTYPES
+    key.update(repr(cols).encode('utf-8'))
+    key.update(repr(dtypes).encode('utf-8'))
+    key.update(getsource(read_csv_file).encode('utf-8'))
+    key.update(getsource(cleanse_data).encode('utf-8'))
+    key.update(getsource(compact_dtypes).encode('utf-8'))
+
+    return key.hexdigest()
+
+
+def remove_stale_cache(cache_dir, kind, stem, cache_file):
+    """
+    Remove the cached snapshots of the same raw file under an older key, and the ones named by key only,
+    so the cache does not grow with every change of the file or the code
+    :param cache_dir: the folder of the cached snapshots
+    :param kind: listing or calendar
+    :param stem: the name of the raw file without its extension
+    :param cache_file: the current snapshot, which is kept
+    :return: None
+    """
+    pattern = re.compile(f'{kind}(_{re.escape(stem)})?' + r'_[0-9a-f]{64}\.parquet')
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if pattern.fullmatch(name) and path != cache_file:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def read_cleansed_file(file, col_scrape_date, listing_data = False, use_pyarrow = False, cache_dir = 'data/cache'):
+    """
+    Read one cleansed snapshot from the parquet cache, or read and cleanse the csv file and cache it.
+    Older snapshots of the same file are removed when a new one is cached
+    :param file: path of the csv file
+    :param col_scrape_date: the column to be used to create scrape_date
+    :param listing_data: specify if the file is listing data or calendar data
+    :param use_pyarrow: parse the csv with pyarrow instead of the C parser
+    :param cache_dir: the folder of the cached snapshots
+    :return: the cleansed df and a dict of FILE, ROWS, BYTES, SECONDS and CACHED
+    """
+    tik = time.time()
+
+    kind = 'listing' if listing_data else 'calendar'
+    stem = os.path.splitext(os.path.basename(file))[0]
+    cache_file = os.path.join(cache_dir, f'{kind}_{stem}_{get_cache_key(file, listing_data)}.parquet')
+
+    if os.path.exists(cache_file):
+        df = pd.read_parquet(cache_file)
+        cached = True
+    else:
+        df, stats = read_csv_file(file, col_scrape_date, listing_data, use_pyarrow)
+        df = compact_dtypes(cleanse_data(df, list_data = listing_data))
+        os.makedirs(cache_dir, exist_ok = True)
+        # write to a temp file first, so a half written file is never read
+        df.to_parquet(cache_file + '.tmp', index = False)
+        os.replace(cache_file + '.tmp', cache_file)
+        remove_stale_cache(cache_dir, kind, stem, cache_file)
+        cached = False
+    tok = time.time()
+
+    stats = {'FILE': file, 'ROWS': df.shape[0], 'BYTES': os.path.getsize(file)
+        , 'SECONDS': round(tok - tik, 2), 'CACHED': cached}
+
+    return df, stats
+
+
+def read_cleansed(path, file_names, col_scrape_date, listing_data = False, file_paths = None
+                  , num_workers = None, use_pyarrow = False, cache_dir = 'data/cache'):
+    """
+    Read multiple cleansed snapshots in parallel, from the cache where possible
+    :param path: file path
+    :param file_names: file names in regex
+    :param col_scrape_date: the column to be used to create scrape_date
+    :param listing_data: specify if the files are listing data or calendar data
+    :param file_paths: optional, only read these files instead of all the files matched
+    :param num_workers: the number of processes, one per cpu if None, 1 to read in this process
+    :param use_pyarrow: parse the csv files with pyarrow instead of the C parser
+    :param cache_dir: the folder of the cached snapshots
+    :return: a list of cleansed df, in the order of the files
+    """
+    if file_paths is None:
+        file_paths = glob.glob(os.path.join(path, file_names))
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(min(num_workers, len(file_paths)), 1)
+
+    args = [(file, col_scrape_date, listing_data, use_pyarrow, cache_dir) for file in file_paths]
+    if num_workers == 1:
+        results = [read_cleansed_file(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers = num_workers) as executor:
+            results = list(executor.map(read_cleansed_file, *zip(*args)))
+
+    for df, stats in results:
+        source = 'cache' if stats['CACHED'] else 'csv'
+        log_time(f"Read {stats['FILE']} from {source}: {stats['ROWS']} rows, {stats['SECONDS']} s")
+
+    return [df for df, stats in results]
 
-        df = pd.read_csv(file, header=0, low_memory=False)
-        if listing_data:
-            cols = [
-                # listing
-                'id', 'last_scraped', 'property_type', 'room_type', 'accommodates'
-                , 'bathrooms', 'bedrooms', 'beds', 'bed_type', 'amenities', 'square_feet'
-                , 'instant_bookable', 'is_business_travel_ready', 'cancellation_policy'
-                , 'require_guest_profile_picture', 'require_guest_phone_verification'
-                , 'guests_included'
-                # calendar
-                , 'minimum_nights', 'maximum_nights', 'minimum_minimum_nights', 'maximum_minimum_nights'
-                , 'minimum_maximum_nights', 'maximum_maximum_nights', 'minimum_nights_avg_ntm'
-                , 'maximum_nights_avg_ntm', 'calendar_updated', 'has_availability', 'availability_30'
-                , 'availability_60', 'availability_90', 'availability_365', 'calendar_last_scraped'
-                # reviews
-                , 'number_of_reviews', 'number_of_reviews_ltm', 'first_review', 'last_review'
-                , 'review_scores_rating', 'review_scores_accuracy', 'review_scores_cleanliness'
-                , 'review_scores_checkin', 'review_scores_communication', 'review_scores_location'
-                , 'review_scores_value', 'reviews_per_month'
-                # prices
-                , 'price', 'weekly_price', 'monthly_price', 'security_deposit', 'cleaning_fee'
-                , 'extra_people'
-                # location
-                , 'street', 'neighbourhood_cleansed', 'city', 'state'
-                , 'zipcode', 'market', 'smart_location', 'country', 'latitude', 'longitude'
-                , 'is_location_exact'
-                # host
-                , 'host_id', 'host_since', 'host_neighbourhood', 'host_response_time'
-                , 'host_response_rate', 'host_acceptance_rate', 'host_is_superhost'
-                , 'calculated_host_listings_count', 'calculated_host_listings_count_entire_homes'
-                , 'calculated_host_listings_count_private_rooms'
-                , 'calculated_host_listings_count_shared_rooms'
-                , 'host_verifications', 'host_has_profile_pic', 'host_identity_verified'
-            ]
-
-            df = df[cols]
-        df['SCRAPED_DATE'] = df[col_scrape_date].min()
-        list_df.append(df)
-
-    return list_df
 
 def agg_to_monthly(df):
     """
@@ -158,6 +1045,169 @@ def agg_to_monthly(df):
     return df_cp
 
 
+def median_from_counts(counts):
+    """
+    Take the counts of each value per group and return the exact median per group,
+    the same as the median of the values
+    :param counts: a series of counts indexed by (ID, YEAR_MONTH, value)
+    :return: a series of medians indexed by (ID, YEAR_MONTH)
+    """
+    keys = ['ID', 'YEAR_MONTH']
+    df = counts.rename('COUNT').reset_index()
+    df.columns = keys + ['VALUE', 'COUNT']
+    df = df.sort_values(by = keys + ['VALUE']).reset_index(drop = True)
+
+    # the rows hold the sorted positions (CUM - COUNT, CUM]
+    total = df.groupby(keys).COUNT.transform('sum')
+    cum = df.groupby(keys).COUNT.cumsum()
+    cum_prev = cum - df.COUNT
+
+    # the lower and upper middle positions, the same for odd counts
+    middles = []
+    for position in [(total + 1) // 2, total // 2 + 1]:
+        idx = (cum_prev < position) & (cum >= position)
+        middles.append(df[idx].set_index(keys).VALUE)
+
+    return (middles[0] + middles[1]) / 2
+
+
+def agg_calendar_chunks(cal_dates, date_end_last = None, chunksize = 1000000):
+    """
+    Aggregate calendar data to monthly by streaming the files in chunks. Each chunk is cleansed, cut to
+    its scrape window and folded into per (ID, YEAR_MONTH) counts, so the daily rows are never all in memory.
+    :param cal_dates: a series of scrape dates indexed by calendar file path, sorted by date (read_scrape_dates)
+    :param date_end_last: the end date for the last calendar, one month after its scraped date if None
+    :param chunksize: the number of rows read at a time
+    :return: a df of monthly calendar data, the same as agg_to_monthly
+    """
+    keys = ['ID', 'YEAR_MONTH']
+    booked = None
+    counts = {'BASE_PRICE': None, 'TXN_PRICE': None}
+
+    def fold(total, parts):
+        parts = ([] if total is None else [total]) + parts
+        return pd.concat(parts).groupby(level = list(range(parts[0].index.nlevels))).sum()
+
+    num_cal = len(cal_dates)
+    for i in range(num_cal):
+        file = cal_dates.index[i]
+
+        # only keep the calendar data b/w the scraped date and the date of next scrape run
+        if i < num_cal - 1:
+            date_end = cal_dates.iloc[i + 1]
+        elif date_end_last is not None:
+            date_end = date_end_last
+        else:
+            date_end = str(pd.to_datetime(cal_dates.iloc[i]).date() + relativedelta.relativedelta(months=1))
+
+        booked_parts = []
+        count_parts = {col: [] for col in counts}
+        for chunk in pd.read_csv(file, usecols = CALENDAR_COLS, dtype = CALENDAR_DTYPES, chunksize = chunksize):
+            chunk = cleanse_data(chunk, list_data = False)
+            chunk = chunk[chunk.DATE < str(date_end)]
+            chunk['YEAR_MONTH'] = chunk.DATE.str[:7]
+
+            booked_parts.append(chunk.groupby(keys).BOOKED.sum())
+            for col in counts:
+                count_parts[col].append(chunk.groupby(keys + [col]).size())
+
+        # fold the file into the running aggregates
+        booked = fold(booked, booked_parts)
+        for col in counts:
+            counts[col] = fold(counts[col], count_parts[col])
+
+    # one row per (ID, YEAR_MONTH), nan medians if all prices are missing
+    df_cal = pd.DataFrame(index = booked.index)
+    for col in counts:
+        df_cal[col] = median_from_counts(counts[col])
+    df_cal['BOOKED'] = booked
+
+    return df_cal.reset_index()
+
+
+# lag features, in the order they are computed: (new column, operation, source column, argument)
+# lag: the value of the source column n rows before in the same listing
+# rolling_median: the median of the last n rows of the source column in the same listing
+# minus: the source column minus another column
+PRICE_LAG_SPEC = [
+    ('PRICE_LAG_1', 'lag', 'TXN_PRICE', 1)
+    , ('PRICE_LAG_2', 'lag', 'TXN_PRICE', 2)
+    , ('PRICE_LAG_3', 'lag', 'TXN_PRICE', 3)
+    , ('PRICE_MINUS_LAG_1', 'minus', 'TXN_PRICE', 'PRICE_LAG_1')
+    , ('PRICE_MINUS_LAG_2', 'minus', 'TXN_PRICE', 'PRICE_LAG_2')
+    , ('PRICE_MINUS_LAG_3', 'minus', 'TXN_PRICE', 'PRICE_LAG_3')
+    , ('PRICE_MA_3', 'rolling_median', 'TXN_PRICE', 3)
+    , ('PRICE_MINUS_MA_3', 'minus', 'TXN_PRICE', 'PRICE_MA_3')
+]
+
+BOOKED_LAG_SPEC = [
+    ('BOOKED_LAG_1', 'lag', 'BOOKED', 1)
+    , ('BOOKED_LAG_3', 'lag', 'BOOKED', 3)
+    , ('BOOKED_LAG1_MINUS_LAG3', 'minus', 'BOOKED_LAG_1', 'BOOKED_LAG_3')
+    , ('BOOKED_LAG1_MA3', 'rolling_median', 'BOOKED_LAG_1', 3)
+    , ('BOOKED_LAG1_MINUS_LAG1MA3', 'minus', 'BOOKED_LAG_1', 'BOOKED_LAG1_MA3')
+]
+
+
+def create_lag_features(df, spec, id_col = 'ID', date_col = 'YEAR_MONTH'):
+    """
+    Take the input data and create the lag, difference and rolling median features in the spec.
+    The data is sorted once by listing and date, and every feature is computed over that order.
+    :param df: a data frame with the id, date and source columns
+    :param spec: a list of (new column, operation, source column, argument), e.g. PRICE_LAG_SPEC
+    :param id_col: the listing column
+    :param date_col: the date column to order by within a listing
+    :return: a data frame with the same columns as the input plus the new columns
+    """
+    # make a copy
+    df_cp = df.copy()
+    num_rows = df_cp.shape[0]
+
+    # sort once, the positions of the rows in (id, date) order
+    df_key = df_cp[[id_col, date_col]].reset_index(drop=True)
+    order = df_key.sort_values(by=[id_col, date_col], kind='mergesort').index.to_numpy()
+
+    # the position of each sorted row within its listing
+    ids = df_key[id_col].to_numpy()[order]
+    group_start = np.r_[True, ids[1:] != ids[:-1]] if num_rows > 0 else np.array([], dtype=bool)
+    starts = np.flatnonzero(group_start)
+    pos = np.arange(num_rows) - np.repeat(starts, np.diff(np.r_[starts, num_rows]))
+
+    def lag(values, n):
+        values_lag = np.full(num_rows, np.nan)
+        values_lag[n:] = values[:num_rows - n]
+        values_lag[pos < n] = np.nan
+        return values_lag
+
+    cols = {}
+
+    def get_col(col):
+        if col not in cols:
+            cols[col] = df_cp[col].to_numpy(dtype=float)[order]
+        return cols[col]
+
+    for col_new, operation, col_source, arg in spec:
+        values = get_col(col_source)
+        if operation == 'lag':
+            cols[col_new] = lag(values, arg)
+        elif operation == 'rolling_median':
+            # nan unless the whole window is there, as rolling(window=n).median()
+            window = np.column_stack([values] + [lag(values, n) for n in range(1, arg)])
+            cols[col_new] = np.median(window, axis=1)
+        elif operation == 'minus':
+            cols[col_new] = values - get_col(arg)
+        else:
+            sys.exit(f'Unknown operation: {operation}')
+
+    # put the rows back in the input order
+    for col_new, operation, col_source, arg in spec:
+        values = np.empty(num_rows)
+        values[order] = cols[col_new]
+        df_cp[col_new] = values
+
+    return df_cp
+
+
 def fs_listing(df, output_all = False):
     """
     Take the input data and create features for the listing dimensions
@@ -235,21 +1285,8 @@ def fs_price(df, monthly = False):
     # make a copy
     df_cp = df.copy()
     df_cp['PRICE_PER_GUEST'] = df_cp.TXN_PRICE/df_cp.GUESTS_INCLUDED
-    #lag
-    df_cp["PRICE_LAG_1"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["TXN_PRICE"].shift(1)
-    df_cp["PRICE_LAG_2"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["TXN_PRICE"].shift(2)
-    df_cp["PRICE_LAG_3"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["TXN_PRICE"].shift(3)
-    # minus lag
-    df_cp["PRICE_MINUS_LAG_1"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_1
-    df_cp["PRICE_MINUS_LAG_2"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_2
-    df_cp["PRICE_MINUS_LAG_3"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_3
-    # moving average/median
-    pma3 = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["TXN_PRICE"].rolling(window=3).median()
-    df_cp['PRICE_MA_3'] = pma3.reset_index(level=0, drop=True).reset_index(level=0, drop=True)
-
-    # minus moving average
-    df_cp["PRICE_MINUS_MA_3"] = df_cp.TXN_PRICE - df_cp.PRICE_MA_3
-
+    # lag, minus lag, moving average/median and minus moving average
+    df_cp = create_lag_features(df_cp, PRICE_LAG_SPEC)
 
     if monthly:
         cols = ['ID', 'YEAR_MONTH','TXN_PRICE', 'PRICE_PER_GUEST'
@@ -303,6 +1340,74 @@ def calculate_months(date1, date2):
     # else:
     #     sys.exit('Wrong input!')
 
+def to_datetime64(dates):
+    """
+    Convert a column or a data frame of dates to a datetime64 array
+    :param dates: a series or a data frame of date str or datetime
+    :return: a 1d array for a series, a 2d array (one column per column) for a data frame
+    """
+    if isinstance(dates, pd.DataFrame):
+        return np.column_stack([pd.to_datetime(dates[col]).to_numpy(dtype='datetime64[ns]') for col in dates])
+    else:
+        return pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[ns]')
+
+
+def calculate_months_col(date1, date2):
+    """
+    calculate months between two columns of dates in one vectorized pass, the same as calculate_months row by row
+    :param date1: a series or a data frame of dates
+    :param date2: a series or a data frame of dates, with the same rows as date1
+    :return: months difference b/w the dates, nan if either date is missing.
+    A series if both inputs are series, otherwise a data frame with the columns of the data frame input
+    """
+    d1 = to_datetime64(date1)
+    d2 = to_datetime64(date2)
+    # one column against several columns
+    if d1.ndim < d2.ndim:
+        d1 = d1[:, None]
+    elif d2.ndim < d1.ndim:
+        d2 = d2[:, None]
+    d1, d2 = np.broadcast_arrays(d1, d2)
+
+    valid = ~(np.isnat(d1) | np.isnat(d2))
+    epoch = np.datetime64(0, 'ns')
+    d1 = np.where(valid, d1, epoch)
+    d2 = np.where(valid, d2, epoch)
+
+    # year*12+month difference
+    m1 = d1.astype('datetime64[M]')
+    m2 = d2.astype('datetime64[M]')
+    months = (m1 - m2).astype(np.int64)
+
+    # date2 moved by the months, the day clipped to the month end like relativedelta
+    start = (m2 + months.astype('timedelta64[M]')).astype('datetime64[D]')
+    days_in_month = ((m2 + (months + 1).astype('timedelta64[M]')).astype('datetime64[D]') - start).astype(np.int64)
+    day = (d2.astype('datetime64[D]') - m2.astype('datetime64[D]')).astype(np.int64)
+    time_of_day = d2 - d2.astype('datetime64[D]')
+    shifted = (start + np.minimum(day, days_in_month - 1).astype('timedelta64[D]')).astype('datetime64[ns]') + time_of_day
+
+    # drop the last month if it is not complete
+    after = d1 >= d2
+    months = np.where(after & (d1 < shifted), months - 1, months)
+    months = np.where(~after & (d1 > shifted), months + 1, months)
+    months = np.abs(months)
+
+    if months.ndim == 1:
+        months = months[:, None]
+        valid = valid[:, None]
+    df_months = pd.DataFrame({i: months[:, i] if valid[:, i].all() else np.where(valid[:, i], months[:, i], np.nan)
+                              for i in range(months.shape[1])})
+
+    # put the index and names back
+    df_in = date2 if isinstance(date2, pd.DataFrame) else date1
+    if isinstance(df_in, pd.DataFrame):
+        df_months.columns = df_in.columns
+        df_months.index = df_in.index
+        return df_months
+    else:
+        return pd.Series(df_months[0].values, index=pd.Series(date1).index)
+
+
 def fs_calendar(df, output_all = False):
     """
     Take the input data and create features for the calendar dimension
@@ -331,16 +1436,8 @@ def fs_booked(df, output_all = False):
     """
     # make a copy
     df_cp = df.copy()
-    df_cp["BOOKED_LAG_1"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["BOOKED"].shift(1)
-    df_cp["BOOKED_LAG_3"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["BOOKED"].shift(3)
-    df_cp["BOOKED_LAG1_MINUS_LAG3"] = df_cp.BOOKED_LAG_1 - df_cp.BOOKED_LAG_3
-
-    # lag1 moving average/median
-    ma3 = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["BOOKED_LAG_1"].rolling(window=3).median()
-    df_cp['BOOKED_LAG1_MA3'] = ma3.reset_index(level=0, drop=True).reset_index(level=0, drop=True)
-
-    # minus moving average
-    df_cp["BOOKED_LAG1_MINUS_LAG1MA3"] = df_cp.BOOKED_LAG_1 - df_cp.BOOKED_LAG1_MA3
+    # lag, lag difference, lag1 moving average/median and minus moving average
+    df_cp = create_lag_features(df_cp, BOOKED_LAG_SPEC)
 
     if output_all:
         cols = ['ID', 'YEAR_MONTH','BOOKED','BOOKED_LAG_1','BOOKED_LAG_3','BOOKED_LAG1_MINUS_LAG3'
@@ -360,9 +1457,9 @@ def fs_review(df, output_all = False):
     # make a copy
     df_cp = df.copy()
 
+    df_months = calculate_months_col(df_cp['SCRAPED_DATE'], df_cp[['FIRST_REVIEW', 'LAST_REVIEW']])
     for col in ['FIRST_REVIEW', 'LAST_REVIEW']:
-        df_cp[f'MONTH_SINCE_{col}'] = df_cp.apply(lambda row: calculate_months(
-            row['SCRAPED_DATE'], row[col]), axis=1)
+        df_cp[f'MONTH_SINCE_{col}'] = df_months[col]
 
     if output_all:
         cols = ['ID', 'YEAR_MONTH', 'NUMBER_OF_REVIEWS', 'MONTH_SINCE_FIRST_REVIEW'
@@ -425,8 +1522,7 @@ def fs_host(df, output_all = False):
     # make a copy
     df_cp = df.copy()
 
-    df_cp['HOST_MONTHS'] = df_cp.apply(lambda row: calculate_months(row['SCRAPED_DATE']
-                                                                    , row['HOST_SINCE']), axis=1)
+    df_cp['HOST_MONTHS'] = calculate_months_col(df_cp['SCRAPED_DATE'], df_cp['HOST_SINCE'])
 
     if output_all:
         cols = ['ID', 'YEAR_MONTH', 'HOST_MONTHS', 'HOST_NEIGHBOURHOOD'
@@ -439,10 +1535,108 @@ def fs_host(df, output_all = False):
     else:
         return df_cp
 
-def fs_final(df, output_all = False):
+def build_history(df, num_months = 3):
+    """
+    Take the monthly data and keep the last months of TXN_PRICE and BOOKED for each listing
+    :param df: a monthly data frame with columns ID, YEAR_MONTH, TXN_PRICE, BOOKED
+    :param num_months: the number of months kept for each listing, enough for the lag features
+    :return: a history data frame indexed by ID, with columns YEAR_MONTH, TXN_PRICE, BOOKED
+    """
+    df_history = df[['ID', 'YEAR_MONTH', 'TXN_PRICE', 'BOOKED']].copy()
+    df_history['YEAR_MONTH'] = df_history.YEAR_MONTH.astype(str).str[:7]
+
+    # keep the last months of each listing
+    df_history = df_history.sort_values(by=['ID', 'YEAR_MONTH'])
+    df_history = df_history.groupby('ID').tail(num_months)
+
+    return df_history.set_index('ID')
+
+
+def save_history(df_history, path = 'data/history.parquet'):
+    """
+    Save the history data frame to a parquet file
+    :param df_history: the output of build_history
+    :param path: path of the parquet file
+    :return: time it takes
+    """
+    tik = time.time()
+
+    df_history.reset_index().to_parquet(path, index = False)
+    tok = time.time()
+
+    return tok - tik
+
+
+def load_history(path = 'data/history.parquet'):
+    """
+    Load the history data frame from a memory-mapped parquet file
+    :param path: path of the parquet file
+    :return: a history data frame indexed by ID
+    """
+    df_history = pd.read_parquet(path, memory_map = True)
+
+    return df_history.set_index('ID')
+
+
+def fs_lag_lookup(df, df_history, num_lags = 3):
+    """
+    Take the input data and look up the price and booked lag features from the history by ID,
+    instead of recomputing them over the full history. Lags of a row are the history months
+    before its YEAR_MONTH, the most recent first.
+    :param df: a data frame with columns ID, YEAR_MONTH, TXN_PRICE
+    :param df_history: the output of build_history or load_history
+    :param num_lags: the number of lags to look up
+    :return: a data frame with the same columns as the input plus the price and booked lag features
+    """
+    # make a copy
+    df_cp = df.copy()
+
+    year_month = pd.to_datetime(df_cp.YEAR_MONTH).dt.strftime('%Y-%m')
+    df_key = pd.DataFrame({'ID': df_cp.ID.values, 'YEAR_MONTH': year_month.values}).drop_duplicates()
+
+    # history months before each requested month, ranked from the most recent
+    df_lag = df_key.join(df_history, on = 'ID', rsuffix = '_HIST', how = 'inner')
+    df_lag = df_lag[df_lag.YEAR_MONTH_HIST < df_lag.YEAR_MONTH]
+    df_lag = df_lag.sort_values(by = ['ID', 'YEAR_MONTH', 'YEAR_MONTH_HIST'], ascending = [True, True, False])
+    df_lag['LAG'] = df_lag.groupby(['ID', 'YEAR_MONTH']).cumcount() + 1
+    df_lag = df_lag[df_lag.LAG <= num_lags]
+
+    # one row per ID and YEAR_MONTH, one column per lag
+    df_lag = df_lag.pivot(index = ['ID', 'YEAR_MONTH'], columns = 'LAG', values = ['TXN_PRICE', 'BOOKED'])
+    df_lag = df_lag.reindex(columns = pd.MultiIndex.from_product([['TXN_PRICE', 'BOOKED'], range(1, num_lags + 1)]))
+    df_lag = df_lag.reindex(pd.MultiIndex.from_arrays([df_cp.ID, year_month]))
+
+    price_lag = df_lag['TXN_PRICE'].to_numpy(dtype = float)
+    booked_lag = df_lag['BOOKED'].to_numpy(dtype = float)
+
+    # price features
+    df_cp["PRICE_LAG_1"] = price_lag[:, 0]
+    df_cp["PRICE_LAG_2"] = price_lag[:, 1]
+    df_cp["PRICE_LAG_3"] = price_lag[:, 2]
+    df_cp["PRICE_MINUS_LAG_1"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_1
+    df_cp["PRICE_MINUS_LAG_2"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_2
+    df_cp["PRICE_MINUS_LAG_3"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_3
+    # median of the current and the last two prices, nan if any is missing
+    df_cp['PRICE_MA_3'] = np.median(np.column_stack([df_cp.TXN_PRICE, price_lag[:, :2]]), axis = 1)
+    df_cp["PRICE_MINUS_MA_3"] = df_cp.TXN_PRICE - df_cp.PRICE_MA_3
+
+    # booked features
+    df_cp["BOOKED_LAG_1"] = booked_lag[:, 0]
+    df_cp["BOOKED_LAG_3"] = booked_lag[:, 2]
+    df_cp["BOOKED_LAG1_MINUS_LAG3"] = df_cp.BOOKED_LAG_1 - df_cp.BOOKED_LAG_3
+    # median of the last three booked, nan if any is missing
+    df_cp['BOOKED_LAG1_MA3'] = np.median(booked_lag[:, :3], axis = 1)
+    df_cp["BOOKED_LAG1_MINUS_LAG1MA3"] = df_cp.BOOKED_LAG_1 - df_cp.BOOKED_LAG1_MA3
+
+    return df_cp
+
+
+def fs_final(df, output_all = False, df_history = None):
     """
     Take the input data and create final features for model API
     :param df: the listing data frame
+    :param df_history: optional, the output of build_history or load_history.
+    If given, the lag features are looked up from it instead of computed over df
     :return: a data frame with all features need for model API
     """
 
@@ -476,41 +1670,24 @@ def fs_final(df, output_all = False):
 
     # price features
     df_cp['PRICE_PER_GUEST'] = df_cp.TXN_PRICE / df_cp.GUESTS_INCLUDED
-    # lag
-    df_cp["PRICE_LAG_1"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["TXN_PRICE"].shift(1)
-    df_cp["PRICE_LAG_2"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["TXN_PRICE"].shift(2)
-    df_cp["PRICE_LAG_3"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["TXN_PRICE"].shift(3)
-    # minus lag
-    df_cp["PRICE_MINUS_LAG_1"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_1
-    df_cp["PRICE_MINUS_LAG_2"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_2
-    df_cp["PRICE_MINUS_LAG_3"] = df_cp.TXN_PRICE - df_cp.PRICE_LAG_3
-    # moving average/median
-    pma3 = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["TXN_PRICE"].rolling(window=3).median()
-    df_cp['PRICE_MA_3'] = pma3.reset_index(level=0, drop=True).reset_index(level=0, drop=True)
-    # minus moving average
-    df_cp["PRICE_MINUS_MA_3"] = df_cp.TXN_PRICE - df_cp.PRICE_MA_3
 
-    # booked features
-    df_cp["BOOKED_LAG_1"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["BOOKED"].shift(1)
-    df_cp["BOOKED_LAG_3"] = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["BOOKED"].shift(3)
-    df_cp["BOOKED_LAG1_MINUS_LAG3"] = df_cp.BOOKED_LAG_1 - df_cp.BOOKED_LAG_3
-    # lag1 moving average/median
-    ma3 = df_cp.sort_values(by='YEAR_MONTH').groupby(["ID"])["BOOKED_LAG_1"].rolling(window=3).median()
-    df_cp['BOOKED_LAG1_MA3'] = ma3.reset_index(level=0, drop=True).reset_index(level=0, drop=True)
-    # minus moving average
-    df_cp["BOOKED_LAG1_MINUS_LAG1MA3"] = df_cp.BOOKED_LAG_1 - df_cp.BOOKED_LAG1_MA3
+    if df_history is not None:
+        # look up the lag features from the history
+        df_cp = fs_lag_lookup(df_cp, df_history)
+    else:
+        # price and booked lag features over one sort
+        df_cp = create_lag_features(df_cp, PRICE_LAG_SPEC + BOOKED_LAG_SPEC)
 
     # location
     df_cp = df_cp.rename(columns={'NEIGHBOURHOOD_CLEANSED': 'NEIGHBOURHOOD'})
 
     # review features
+    df_months = calculate_months_col(df_cp['YEAR_MONTH'], df_cp[['FIRST_REVIEW', 'LAST_REVIEW']])
     for col in ['FIRST_REVIEW', 'LAST_REVIEW']:
-        df_cp[f'MONTH_SINCE_{col}'] = df_cp.apply(lambda row: calculate_months(
-            row['YEAR_MONTH'], row[col]), axis=1)
+        df_cp[f'MONTH_SINCE_{col}'] = df_months[col]
 
     # host
-    df_cp['HOST_MONTHS'] = df_cp.apply(lambda row: calculate_months(row['HOST_SINCE'],
-                                                                    row['YEAR_MONTH']), axis=1)
+    df_cp['HOST_MONTHS'] = calculate_months_col(df_cp['HOST_SINCE'], df_cp['YEAR_MONTH'])
 
     # put YEAR_MONTH back to str
     df_cp["YEAR_MONTH"] = df_cp.YEAR_MONTH.astype(str).str[:7]
@@ -555,6 +1732,48 @@ def fs_final(df, output_all = False):
         return df_cp
 
 
+# the columns of fs_daily that are not model features
+DAILY_NON_FEATURES = ['ID', 'DATE', 'YEAR_MONTH', 'BASE_PRICE', 'BOOKED']
+
+
+def fs_daily(df, df_listing = None):
+    """
+    Take cleansed calendar data and create the features of each listing and date, for pricing single nights
+    :param df: cleansed calendar data, with columns ID, DATE, SCRAPED_DATE, BASE_PRICE, TXN_PRICE,
+    MINIMUM_NIGHTS, MAXIMUM_NIGHTS, BOOKED
+    :param df_listing: optional, features of each listing indexed by ID, e.g. ROOM_TYPE and ACCOMMODATES,
+    added to each of its dates
+    :return: a data frame with the columns DAILY_NON_FEATURES and the features, floats as float32 and
+    str columns as categoricals. TXN_PRICE and PRICE_TO_MEDIAN depend on the price, see set_daily_price_features
+    """
+    # make a copy
+    df_cp = df[['ID', 'DATE', 'SCRAPED_DATE', 'BASE_PRICE', 'TXN_PRICE'
+        , 'MINIMUM_NIGHTS', 'MAXIMUM_NIGHTS', 'BOOKED']].copy()
+
+    df_cp['DATE'] = df_cp.DATE.astype(str)
+    dates = pd.to_datetime(df_cp.DATE, format = '%Y-%m-%d')
+    df_cp['YEAR_MONTH'] = df_cp.DATE.str[:7]
+
+    # time features, a weekend night is a Friday or Saturday night
+    df_cp['DAY_OF_WEEK'] = dates.dt.dayofweek
+    df_cp['WEEKEND'] = df_cp.DAY_OF_WEEK.isin([4, 5]).astype(int)
+    df_cp['DAY_OF_MONTH'] = dates.dt.day
+    df_cp['MONTH'] = dates.dt.month
+    df_cp['WEEK_OF_YEAR'] = dates.dt.isocalendar().week.astype(int).to_numpy()
+    # how many days ahead of the scrape the night is
+    df_cp['DAYS_AHEAD'] = (dates - pd.to_datetime(df_cp.SCRAPED_DATE.astype(str))).dt.days
+
+    # price features, relative to the listing's usual price in the same scrape
+    df_cp['PRICE_MEDIAN'] = df_cp.groupby(['ID', 'SCRAPED_DATE'], observed = True).TXN_PRICE.transform('median')
+    df_cp['PRICE_TO_MEDIAN'] = df_cp.TXN_PRICE / df_cp.PRICE_MEDIAN
+
+    df_cp = df_cp.drop('SCRAPED_DATE', axis = 1)
+    if df_listing is not None:
+        df_cp = df_cp.join(df_listing, on = 'ID')
+
+    return compact_features(df_cp, keys = ['ID', 'DATE', 'YEAR_MONTH', 'BOOKED'])
+
+
 # def fs_(df, output_all = False):
 #     """
 #     Take the input data and create features for the time dimension
@@ -1,79 +1,268 @@
 # Here saves the functions for model api
 
 import time
+import threading
+import os
+import hashlib
 from src.func_data_diagnosis import *
 from src.func_data_engineering import *
 import joblib
+from scipy import sparse
 
 
-def global_model_api(df, pred_time = False):
+class GlobalModel:
+    """
+    Keep the global model and its one-hot encoder in memory, so they are loaded once
+    and not on every prediction. The files are reloaded when they change on disk.
+    If the encoder file holds a vocabulary (build_vocab) instead of a one-hot encoder,
+    the categorical columns are passed to the model as categoricals.
+    """
+
+    col_cate = ['PROPERTY_TYPE', 'ROOM_TYPE', 'BED_TYPE', 'CANCELLATION_POLICY'
+        , 'NEIGHBOURHOOD']
+
+    def __init__(self, model_path='model/model_base.model', ohe_path='model/ohe_base.ohe', sparse=False, n_jobs=None):
+        """
+        :param model_path: path of the trained model
+        :param ohe_path: path of the fitted one-hot encoder
+        :param sparse: if the model is trained on sparse features, see encode_data
+        :param n_jobs: optional, the number of threads of the model, e.g. 1 in each worker of a process pool
+        """
+        self.model_path = model_path
+        self.ohe_path = ohe_path
+        self.sparse = sparse
+        self.n_jobs = n_jobs
+        self.model = None
+        self.ohe = None
+        self.mtimes = None
+        self.version = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def get_mtimes(self):
+        return os.path.getmtime(self.model_path), os.path.getmtime(self.ohe_path)
+
+    def load(self):
+        """
+        Load (or reload) the model and the encoder from disk
+        :return: the load time in seconds
+        """
+        tic = time.time()
+        with self.lock:
+            mtimes = self.get_mtimes()
+            self.ohe = joblib.load(self.ohe_path)
+            self.model = joblib.load(self.model_path)
+            if self.n_jobs is not None:
+                self.model.set_params(n_jobs=self.n_jobs)
+            self.mtimes = mtimes
+            # changes whenever a file is reloaded, e.g. to invalidate cached predictions
+            self.version = hashlib.md5(repr((self.model_path, self.ohe_path, mtimes)).encode()).hexdigest()[:12]
+        toc = time.time()
+
+        return round(toc - tic, 2)
+
+    def reload_if_changed(self):
+        """
+        Reload the model and the encoder if either file changed since the last load
+        :return: True if reloaded, otherwise False
+        """
+        if self.get_mtimes() != self.mtimes:
+            self.load()
+            return True
+        else:
+            return False
+
+    def encode_parts(self, df):
+        """
+        One-hot encode the categorical columns
+        :param df: a dataframe, the output of fs_final
+        :return: the numerical columns as a dataframe, and the encoded columns as
+        a sparse CSR matrix in sparse mode, otherwise a dense array.
+        With a vocabulary, all the columns with the categorical columns as categoricals, and None
+        """
+        with self.lock:
+            ohe = self.ohe
+        if isinstance(ohe, dict):
+            return apply_vocab(df, ohe), None
+
+        # encode
+        ohe_cols = ohe.transform(df[self.col_cate])
+        if self.sparse:
+            ohe_cols = sparse.csr_matrix(ohe_cols)
+        elif sparse.issparse(ohe_cols):
+            ohe_cols = ohe_cols.toarray()
+
+        return df.drop(self.col_cate, axis=1), ohe_cols
+
+    def combine(self, df_num, ohe_cols):
+        """
+        Put the encoded columns after the numerical columns
+        :param df_num: the numerical columns, from encode_parts
+        :param ohe_cols: the encoded columns, from encode_parts
+        :return: a CSR matrix in sparse mode, otherwise a dataframe with the index of df_num
+        """
+        if ohe_cols is None:
+            return df_num
+        if self.sparse:
+            return stack_sparse(df_num, ohe_cols)
+
+        df_ohe = pd.DataFrame(ohe_cols)
+        # get index back
+        df_ohe.index = df_num.index
+
+        return pd.concat([df_num, df_ohe], axis=1)
+
+    def encode(self, df):
+        """
+        One-hot encode the categorical columns and put them after the numerical columns
+        :param df: a dataframe, the output of fs_final
+        :return: an encoded dataframe with the same index, or a CSR matrix in sparse mode
+        """
+        return self.combine(*self.encode_parts(df))
+
+    def predict(self, df, chunksize=None):
+        """
+        Encode the features and predict the number of nights booked
+        :param df: a dataframe, the output of fs_final without ID, YEAR_MONTH and BOOKED
+        :param chunksize: optional, the number of rows predicted at a time, all at once if None
+        :return: an array of predictions
+        """
+        return self.predict_encoded(self.encode(df), chunksize)
+
+    def predict_encoded(self, df_ohe, chunksize=None):
+        """
+        Predict the number of nights booked from encoded features,
+        or the probability of being booked for a classifier, e.g. a daily model
+        :param df_ohe: a dataframe, the output of encode
+        :param chunksize: optional, the number of rows predicted at a time, all at once if None
+        :return: an array of predictions
+        """
+        with self.lock:
+            model = self.model
+
+        if hasattr(model, 'predict_proba'):
+            predict = lambda X: model.predict_proba(X)[:, 1]
+        else:
+            predict = model.predict
+
+        if chunksize is None:
+            return predict(df_ohe)
+
+        # rows of a dataframe or a CSR matrix
+        rows = df_ohe.iloc if isinstance(df_ohe, pd.DataFrame) else df_ohe
+        return np.concatenate([predict(rows[start:start + chunksize])
+                               for start in range(0, df_ohe.shape[0], chunksize)])
+
+
+# the resident model shared by all calls in this process
+_global_model = None
+
+
+def get_global_model(model_path='model/model_base.model', ohe_path='model/ohe_base.ohe', sparse=False, n_jobs=None):
+    """
+    Return the resident GlobalModel, loading it on the first call and reloading it if the files changed
+    :param model_path: path of the trained model
+    :param ohe_path: path of the fitted one-hot encoder
+    :param sparse: if the model is trained on sparse features
+    :param n_jobs: optional, the number of threads of the model
+    :return: a GlobalModel
+    """
+    global _global_model
+
+    if (_global_model is None) or \
+            (_global_model.model_path, _global_model.ohe_path, _global_model.sparse, _global_model.n_jobs) \
+            != (model_path, ohe_path, sparse, n_jobs):
+        _global_model = GlobalModel(model_path, ohe_path, sparse, n_jobs)
+    else:
+        _global_model.reload_if_changed()
+
+    return _global_model
+
+
+# the resident lag history shared by all calls in this process
+_history = {'path': None, 'mtime': None, 'df': None}
+
+
+def get_history(path='data/history.parquet', csv_path='data/test_mar_to_may20.csv', num_months=3):
+    """
+    Return the resident lag history, loading it on the first call and reloading it if the file changed.
+    If the parquet file does not exist yet or is older than the raw monthly csv, (re)build it from the csv,
+    so a new scrape month is picked up without deleting the file by hand.
+    :param path: path of the history parquet file
+    :param csv_path: path of the raw monthly data to build the history from
+    :param num_months: the number of months kept for each listing
+    :return: a history data frame indexed by ID
+    """
+    stale = os.path.exists(csv_path) and os.path.exists(path) and os.path.getmtime(csv_path) > os.path.getmtime(path)
+    if (not os.path.exists(path)) or stale:
+        df_data = pd.read_csv(csv_path, low_memory=False)
+        save_history(build_history(df_data, num_months), path)
+
+    mtime = os.path.getmtime(path)
+    if (_history['path'], _history['mtime']) != (path, mtime):
+        _history['df'] = load_history(path)
+        _history['path'] = path
+        _history['mtime'] = mtime
+
+    return _history['df']
+
+
+# the input columns of the model APIs
+API_COLS = [
+    # list
+    'ID', 'YEAR_MONTH', 'PROPERTY_TYPE', 'ROOM_TYPE', 'ACCOMMODATES'
+    , 'BATHROOMS', 'BEDROOMS', 'BEDS', 'BED_TYPE', 'SQUARE_FEET'
+    , 'INSTANT_BOOKABLE', 'GUESTS_INCLUDED', 'CANCELLATION_POLICY'
+    , 'REQUIRE_GUEST_PROFILE_PICTURE', 'REQUIRE_GUEST_PHONE_VERIFICATION'
+    # cal
+    , 'AVG_MINIMUM_NIGHTS', 'AVG_MAXIMUM_NIGHTS'
+    # host
+    , 'HOST_RESPONSE_RATE', 'HOST_SINCE'
+    , 'HOST_ACCEPTANCE_RATE', 'HOST_IS_SUPERHOST', 'HOST_LISTINGS_COUNT'
+    , 'HOST_HAS_PROFILE_PIC', 'HOST_IDENTITY_VERIFIED'
+    # review
+    , 'NUMBER_OF_REVIEWS', 'FIRST_REVIEW', 'LAST_REVIEW'
+    , 'REVIEW_SCORES_RATING', 'REVIEW_SCORES_ACCURACY'
+    , 'REVIEW_SCORES_CLEANLINESS', 'REVIEW_SCORES_CHECKIN'
+    , 'REVIEW_SCORES_COMMUNICATION', 'REVIEW_SCORES_LOCATION'
+    , 'REVIEW_SCORES_VALUE', 'REVIEWS_PER_MONTH'
+    # location
+    , 'NEIGHBOURHOOD_CLEANSED', 'IS_LOCATION_EXACT'
+    # , 'LATITUDE', 'LONGITUDE'
+    # price
+    , 'TXN_PRICE', 'SECURITY_DEPOSIT', 'CLEANING_FEE', 'EXTRA_PEOPLE'
+]
+
+
+def global_model_api(df, pred_time = False, model = None, df_history = None):
     """
     Take the input dataframe and predict the demand (number of nights booked)
     :param df: a dataframe with columns: ACCOMMODATES...NEIGHBOURHOOD_CLEANSED
+    :param model: a GlobalModel, defaults to the resident one from get_global_model
+    :param df_history: the lag history indexed by ID, defaults to the resident one from get_history
     :return: a dataframe with the columns: ID, YEAR_MONTH, PRICE, BOOKED
     """
     # record
     tic = time.time()
 
     # input validation
-    col_list = [
-        # list
-        'ID', 'YEAR_MONTH', 'PROPERTY_TYPE', 'ROOM_TYPE', 'ACCOMMODATES'
-        , 'BATHROOMS', 'BEDROOMS', 'BEDS', 'BED_TYPE', 'SQUARE_FEET'
-        , 'INSTANT_BOOKABLE', 'GUESTS_INCLUDED', 'CANCELLATION_POLICY'
-        , 'REQUIRE_GUEST_PROFILE_PICTURE', 'REQUIRE_GUEST_PHONE_VERIFICATION'
-        # cal
-        , 'AVG_MINIMUM_NIGHTS', 'AVG_MAXIMUM_NIGHTS'
-        # host
-        , 'HOST_RESPONSE_RATE', 'HOST_SINCE'
-        , 'HOST_ACCEPTANCE_RATE', 'HOST_IS_SUPERHOST', 'HOST_LISTINGS_COUNT'
-        , 'HOST_HAS_PROFILE_PIC', 'HOST_IDENTITY_VERIFIED'
-        # review
-        , 'NUMBER_OF_REVIEWS', 'FIRST_REVIEW', 'LAST_REVIEW'
-        , 'REVIEW_SCORES_RATING', 'REVIEW_SCORES_ACCURACY'
-        , 'REVIEW_SCORES_CLEANLINESS', 'REVIEW_SCORES_CHECKIN'
-        , 'REVIEW_SCORES_COMMUNICATION', 'REVIEW_SCORES_LOCATION'
-        , 'REVIEW_SCORES_VALUE', 'REVIEWS_PER_MONTH'
-        # location
-        , 'NEIGHBOURHOOD_CLEANSED', 'IS_LOCATION_EXACT'
-        # , 'LATITUDE', 'LONGITUDE'
-        # price
-        , 'TXN_PRICE', 'SECURITY_DEPOSIT', 'CLEANING_FEE', 'EXTRA_PEOPLE'
-    ]
-    check_dataframe(df, col_list)
+    check_dataframe(df, API_COLS)
 
     # make a copy
     df_cp = df.copy()
+    # the demand to predict
+    df_cp['BOOKED'] = np.nan
 
-    # read the raw data for lag features
-    df_data = pd.read_csv('data/test_mar_to_may20.csv', low_memory=False)
-    df_data = df_data[col_list+['BOOKED']]
-
-    # append df to df_data
-    df_data = df_data.append(df_cp, ignore_index=True)
-    # ensure data type
+    # lag features are looked up by ID from the history
+    if df_history is None:
+        df_history = get_history()
 
     # feature engineering
-    df_data = fs_final(df_data, output_all=True)
+    df_data = fs_final(df_cp, output_all=True, df_history=df_history)
 
-    # subset to only df rows
-    min_date = df_cp.YEAR_MONTH.min()
-    df_data = df_data[df_data.YEAR_MONTH >= min_date]
-
-    # read ohe transfermor and encode data
-    ohe = joblib.load("model/ohe_base.ohe")
-    col_cate = ['PROPERTY_TYPE', 'ROOM_TYPE', 'BED_TYPE', 'CANCELLATION_POLICY'
-    , 'NEIGHBOURHOOD']
-    # encode
-    df_ohe = pd.DataFrame(ohe.transform(df_data[col_cate]))
-    # get index back
-    df_ohe.index = df_data.index
-    # put the encoded columns and numerical columns together
-    df_num = df_data.drop(col_cate, axis=1)
-    df_data = pd.concat([df_num, df_ohe], axis=1)
-
-    # read model and predict
-    model = joblib.load('model/model_base.model')
+    # encode data and predict with the resident model
+    if model is None:
+        model = get_global_model()
 
     df_pred = df_data[['ID','YEAR_MONTH','TXN_PRICE']]
     df_data = df_data.drop(['ID', 'YEAR_MONTH', 'BOOKED'], axis=1)
@@ -96,5 +285,295 @@ def global_model_api(df, pred_time = False):
         return df_pred
 
 
+def batch_model_api(df, chunksize=100000, pred_time=False, model=None, df_history=None):
+    """
+    Take many listings x months x prices and predict the demand (number of nights booked) in one batch.
+    The features are computed and encoded once per ID and YEAR_MONTH, then repeated for its prices a chunk
+    of rows at a time, so the memory peak grows with the listings and the chunk, not with the prices
+    :param df: a dataframe with the columns of global_model_api, but the prices to score in PRICE instead of TXN_PRICE,
+    one row per ID, YEAR_MONTH and PRICE
+    :param chunksize: the number of rows encoded and predicted at a time
+    :param model: a GlobalModel, defaults to the resident one from get_global_model
+    :param df_history: the lag history indexed by ID, defaults to the resident one from get_history
+    :return: a dataframe with the columns: ID, YEAR_MONTH, PRICE, BOOKED, in the order of the input
+    """
+    # record
+    tic = time.time()
+
+    # input validation
+    check_dataframe(df, [col for col in API_COLS if col != 'TXN_PRICE'] + ['PRICE'])
+
+    # the listing (ID and YEAR_MONTH) of each row, and the first row of each listing, from integer codes
+    # as a MultiIndex would hold a tuple per row
+    id_codes = pd.factorize(df.ID)[0]
+    month_codes, months = pd.factorize(df.YEAR_MONTH)
+    _, first, listing = np.unique(id_codes * len(months) + month_codes, return_index=True, return_inverse=True)
+    # one row per listing, its first price stands in for the transaction price
+    df_listings = df.iloc[first].drop(columns='TXN_PRICE', errors='ignore').rename(columns={'PRICE': 'TXN_PRICE'})
+
+    # lag features are looked up by ID from the history
+    if df_history is None:
+        df_history = get_history()
+    if model is None:
+        model = get_global_model()
+
+    # feature engineering and encoding, once per listing
+    df_data, df_num, ohe_cols = encode_listings(df_listings, model, df_history)
+
+    df_pred = pd.DataFrame({
+        'ID': df_data.ID.to_numpy()[listing]
+        , 'YEAR_MONTH': df_data.YEAR_MONTH.to_numpy()[listing]
+        , 'PRICE': df.PRICE.to_numpy(dtype=float)
+    })
+    df_pred['BOOKED'] = score_rows(model, df_num, ohe_cols, listing, df_pred.PRICE.to_numpy(), chunksize)
+
+    toc = time.time()
+    api_time = round(toc - tic, 2)
+
+    if pred_time:
+        return df_pred, api_time
+    else:
+        return df_pred
+
+
+def set_price_features(df, prices):
+    """
+    Set the transaction price and recompute the features derived from it, the same as fs_final with a lag history.
+    All the other features do not depend on the price
+    :param df: a dataframe with the columns GUESTS_INCLUDED and PRICE_LAG_1...PRICE_LAG_3, changed in place
+    :param prices: an array of prices, one per row
+    :return: None
+    """
+    df['TXN_PRICE'] = prices
+    df['PRICE_PER_GUEST'] = prices / df.GUESTS_INCLUDED.to_numpy()
+    for lag in [1, 2, 3]:
+        df[f'PRICE_MINUS_LAG_{lag}'] = prices - df[f'PRICE_LAG_{lag}'].to_numpy()
+    # median of the current and the last two prices, nan if any is missing
+    df['PRICE_MA_3'] = np.median(np.column_stack([prices, df.PRICE_LAG_1, df.PRICE_LAG_2]), axis=1)
+    df['PRICE_MINUS_MA_3'] = prices - df.PRICE_MA_3.to_numpy()
+
+
+def encode_listings(df, model, df_history):
+    """
+    Compute and encode the features of listings once, for scoring them at many prices with score_prices
+    :param df: a dataframe with the columns of global_model_api, one row per ID and YEAR_MONTH,
+    TXN_PRICE can be any price, the price features are recomputed for each price
+    :param model: a GlobalModel
+    :param df_history: the lag history indexed by ID
+    :return: the features with ID and YEAR_MONTH, and the numerical and encoded columns from encode_parts
+    """
+    # make a copy
+    df_cp = df.copy()
+    # the demand to predict
+    df_cp['BOOKED'] = np.nan
+
+    df_data = fs_final(df_cp, output_all=True, df_history=df_history)
+    df_num, ohe_cols = model.encode_parts(df_data.drop(['ID', 'YEAR_MONTH', 'BOOKED'], axis=1))
+
+    return df_data, df_num.reset_index(drop=True), ohe_cols
 
 
+def predict_rows(model, df_num, ohe_cols, idx, prices, chunksize=100000, set_features=set_price_features):
+    """
+    Predict encoded rows at given prices, the rows are repeated by idx a chunk at a time,
+    and only the price features are recomputed
+    :param model: a GlobalModel
+    :param df_num: the numerical columns, from encode_parts
+    :param ohe_cols: the encoded columns, from encode_parts
+    :param idx: an array of the row of df_num and ohe_cols of each prediction
+    :param prices: an array of the price of each prediction
+    :param chunksize: the number of predictions made at a time
+    :param set_features: the function recomputing the price features in place, e.g. set_price_features
+    :return: a float32 array of predictions, in the order of idx
+    """
+    pred = np.empty(len(idx), dtype=np.float32)
+    for start in range(0, len(idx), chunksize):
+        stop = min(start + chunksize, len(idx))
+        df_chunk = df_num.take(idx[start:stop]).reset_index(drop=True)
+        set_features(df_chunk, prices[start:stop])
+        pred[start:stop] = model.predict_encoded(
+            model.combine(df_chunk, None if ohe_cols is None else ohe_cols[idx[start:stop]]))
+
+    return pred
+
+
+def predict_prices(model, df_num, ohe_cols, prices, chunksize=100000, set_features=set_price_features):
+    """
+    Predict encoded rows at their candidate prices, the rows are repeated for the prices
+    a chunk at a time, and only the price features are recomputed
+    :param model: a GlobalModel
+    :param df_num: the numerical columns, from encode_parts
+    :param ohe_cols: the encoded columns, from encode_parts
+    :param prices: a 2d array with one row of prices per row
+    :param chunksize: the number of rows (rows x prices) predicted at a time
+    :param set_features: the function recomputing the price features in place, e.g. set_price_features
+    :return: a 2d float32 array of predictions, one row per row and one column per price
+    """
+    num_rows, num_prices = prices.shape
+
+    # repeat each row for its prices
+    idx = np.repeat(np.arange(num_rows), num_prices)
+    pred = predict_rows(model, df_num, ohe_cols, idx, prices.ravel(), chunksize, set_features)
+
+    return pred.reshape(num_rows, num_prices)
+
+
+def score_prices(model, df_num, ohe_cols, prices, chunksize=100000):
+    """
+    Predict the demand of encoded listings at their candidate prices,
+    the listings are repeated for the prices and only the price features are recomputed, see set_price_features
+    :param model: a GlobalModel
+    :param df_num: the numerical columns, from encode_listings
+    :param ohe_cols: the encoded columns, from encode_listings
+    :param prices: a 2d array with one row of prices per listing
+    :param chunksize: the number of rows (listings x prices) predicted at a time
+    :return: an array of BOOKED, the prices of each listing in order
+    """
+    idx = np.repeat(np.arange(prices.shape[0]), prices.shape[1])
+
+    return score_rows(model, df_num, ohe_cols, idx, prices.ravel(), chunksize)
+
+
+def score_rows(model, df_num, ohe_cols, idx, prices, chunksize=100000):
+    """
+    Predict the demand of encoded listings at given prices, any number of prices per listing, see predict_rows
+    :param model: a GlobalModel
+    :param df_num: the numerical columns, from encode_listings
+    :param ohe_cols: the encoded columns, from encode_listings
+    :param idx: an array of the listing of each price
+    :param prices: an array of prices
+    :param chunksize: the number of prices predicted at a time
+    :return: an array of BOOKED, one per price
+    """
+    booked = predict_rows(model, df_num, ohe_cols, idx, prices, chunksize)
+
+    # output validation, inf, nan and negatives to 0
+    booked = np.nan_to_num(booked, nan=0, posinf=0, neginf=0)
+
+    return np.clip(booked, 0, None).astype(int)
+
+
+def price_model_api(df, prices, chunksize=100000, pred_time=False, model=None, df_history=None):
+    """
+    Take listings and their candidate prices and predict the demand (number of nights booked) at each price.
+    The features are computed and encoded once per listing, then repeated for the prices, and only
+    the price features are recomputed, see set_price_features
+    :param df: a dataframe with the columns of global_model_api, one row per ID and YEAR_MONTH, TXN_PRICE is not needed
+    :param prices: the candidate prices, an array of the same prices for all rows,
+    or a 2d array with one row of prices per row of df
+    :param chunksize: the number of rows (listings x prices) predicted at a time
+    :param model: a GlobalModel, defaults to the resident one from get_global_model
+    :param df_history: the lag history indexed by ID, defaults to the resident one from get_history
+    :return: a dataframe with the columns: ID, YEAR_MONTH, PRICE, BOOKED, the prices of each input row in order
+    """
+    # record
+    tic = time.time()
+
+    # input validation
+    check_dataframe(df, [col for col in API_COLS if col != 'TXN_PRICE'])
+
+    num_rows = df.shape[0]
+    prices = np.broadcast_to(np.asarray(prices, dtype=float), (num_rows, np.shape(prices)[-1]))
+    num_prices = prices.shape[1]
+
+    # make a copy, the first prices stand in for the transaction prices
+    df_cp = df.copy()
+    df_cp['TXN_PRICE'] = prices[:, 0]
+
+    # lag features are looked up by ID from the history
+    if df_history is None:
+        df_history = get_history()
+    if model is None:
+        model = get_global_model()
+
+    # feature engineering and encoding, once per listing
+    df_data, df_num, ohe_cols = encode_listings(df_cp, model, df_history)
+
+    df_pred = pd.DataFrame({
+        'ID': np.repeat(df_data.ID.to_numpy(), num_prices)
+        , 'YEAR_MONTH': np.repeat(df_data.YEAR_MONTH.to_numpy(), num_prices)
+        , 'PRICE': prices.ravel()
+    })
+    df_pred['BOOKED'] = score_prices(model, df_num, ohe_cols, prices, chunksize)
+
+    toc = time.time()
+    api_time = round(toc - tic, 2)
+
+    if pred_time:
+        return df_pred, api_time
+    else:
+        return df_pred
+
+
+# the resident daily model shared by all calls in this process
+_daily_model = None
+
+
+def get_daily_model(model_path='model/model_daily.model', vocab_path='model/vocab_daily.vocab'):
+    """
+    Return the resident daily model, loading it on the first call and reloading it if the files changed
+    :param model_path: path of the trained classifier of booked nights
+    :param vocab_path: path of the vocabulary of its categorical columns (build_vocab), empty if there are none
+    :return: a GlobalModel
+    """
+    global _daily_model
+
+    if (_daily_model is None) or ((_daily_model.model_path, _daily_model.ohe_path) != (model_path, vocab_path)):
+        _daily_model = GlobalModel(model_path, vocab_path)
+    else:
+        _daily_model.reload_if_changed()
+
+    return _daily_model
+
+
+def set_daily_price_features(df, prices):
+    """
+    Set the price of the nights and recompute the features derived from it, the same as fs_daily
+    :param df: a dataframe with the column PRICE_MEDIAN, changed in place
+    :param prices: an array of prices, one per row
+    :return: None
+    """
+    df['TXN_PRICE'] = prices.astype(np.float32)
+    df['PRICE_TO_MEDIAN'] = (prices / df.PRICE_MEDIAN.to_numpy()).astype(np.float32)
+
+
+def daily_model_api(df, prices, chunksize=100000, pred_time=False, model=None):
+    """
+    Take listing nights and their candidate prices and predict the probability that each night is booked at each price.
+    The features are encoded once per night, then repeated for the prices a chunk at a time,
+    so the nights x prices grid is only kept as the array of probabilities
+    :param df: a dataframe of nights, the output of fs_daily
+    :param prices: the candidate prices, an array of the same prices for all rows,
+    or a 2d array with one row of prices per row of df
+    :param chunksize: the number of rows (nights x prices) predicted at a time
+    :param model: a GlobalModel of a classifier, defaults to the resident one from get_daily_model
+    :return: a 2d float32 array of probabilities, one row per row of df and one column per price
+    """
+    # record
+    tic = time.time()
+
+    # input validation
+    check_dataframe(df, ['ID', 'DATE', 'PRICE_MEDIAN', 'TXN_PRICE', 'PRICE_TO_MEDIAN'])
+
+    num_rows = df.shape[0]
+    prices = np.broadcast_to(np.asarray(prices, dtype=float), (num_rows, np.shape(prices)[-1]))
+
+    if model is None:
+        model = get_daily_model()
+
+    # encoding, once per night
+    df_num, ohe_cols = model.encode_parts(df.drop(columns=DAILY_NON_FEATURES, errors='ignore'))
+    df_num = df_num.reset_index(drop=True)
+
+    prob = predict_prices(model, df_num, ohe_cols, prices, chunksize, set_features=set_daily_price_features)
+
+    # output validation, nan to 0
+    prob = np.clip(np.nan_to_num(prob, nan=0, posinf=0, neginf=0), 0, 1)
+
+    toc = time.time()
+    api_time = round(toc - tic, 2)
+
+    if pred_time:
+        return prob, api_time
+    else:
+        return prob
@@ -0,0 +1,80 @@
+# Here saves the functions for the model server
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.func_model_api import *
+
+
+def make_handler(model):
+    """
+    Create a request handler class bound to a resident model
+    :param model: a GlobalModel, loaded once and shared by all requests
+    :return: a BaseHTTPRequestHandler class
+    """
+
+    class ModelHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, code, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok', 'model_path': model.model_path
+                                     , 'model_mtime': model.mtimes[0]})
+            else:
+                self.send_json(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            if self.path == '/reload':
+                self.send_json(200, {'load_time': model.load()})
+            elif self.path == '/predict':
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    records = json.loads(self.rfile.read(length))
+                    df = pd.DataFrame.from_records(records)
+
+                    model.reload_if_changed()
+                    df_pred, api_time = global_model_api(df, pred_time=True, model=model)
+                except (Exception, SystemExit) as e:
+                    # input checks in this repo exit with sys.exit, keep the server alive
+                    self.send_json(400, {'error': str(e)})
+                    return
+                self.send_json(200, {'api_time': api_time
+                                     , 'predictions': df_pred.to_dict(orient='records')})
+            else:
+                self.send_json(404, {'error': 'Not found'})
+
+        def log_message(self, format, *args):
+            log_time(f'{self.address_string()} {format % args}')
+
+    return ModelHandler
+
+
+def serve_model(host='127.0.0.1', port=8050, model_path='model/model_base.model', ohe_path='model/ohe_base.ohe'
+                , sparse=False):
+    """
+    Serve the global model over local HTTP. The model and the encoder are loaded once at start-up
+    and reloaded when the files change.
+    POST /predict takes a json list of records (the global_model_api input) and returns the predictions;
+    POST /reload forces a reload; GET /health reports the loaded model.
+    :param host: host to bind, local only by default
+    :param port: port to bind
+    :param model_path: path of the trained model
+    :param ohe_path: path of the fitted one-hot encoder
+    :param sparse: if the model is trained on sparse features
+    :return: None, runs until interrupted
+    """
+    model = get_global_model(model_path, ohe_path, sparse)
+    server = ThreadingHTTPServer((host, port), make_handler(model))
+    log_time(f'Model server listening on {host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -3,6 +3,8 @@ from sklearn.preprocessing import OneHotEncoder
 import pandas as pd
 import time
 import sys
+import os
+import joblib
 from src.func_model_tracker import *
 
 
@@ -60,15 +62,39 @@ def split_data(df, test_month, val_month=None):
             sys.exit('Inappropriate period selection')
 
 
-def encode_data(cols, df_train, df_test=None, df_val=None, out_encoder = False):
+def encode_data(cols, df_train, df_test=None, df_val=None, out_encoder = False, sparse = False, native = False):
     """
     Encode categorical columns in train, val and test datasets
     :param df_train: training data
     :param df_val: val data
     :param df_test: test data
     :param cols: categorical columns
+    :param sparse: if True, return CSR matrices of the numerical and one-hot encoded columns
+    for XGBoost instead of dense data frames, see stack_sparse
+    :param native: if True, keep the categorical columns as categoricals of a vocabulary instead of
+    one-hot encoding them, for XGBoost with enable_categorical=True. The vocabulary is the encoder
     :return:
     """
+    if native:
+        vocab = build_vocab(df_train, cols)
+        X_train = apply_vocab(df_train, vocab)
+
+        if (df_test is None) & (df_val is None) & (out_encoder):
+            return X_train, vocab
+
+        return X_train, apply_vocab(df_val, vocab), apply_vocab(df_test, vocab)
+
+    if sparse:
+        ohe = OneHotEncoder(handle_unknown='ignore', sparse=True)
+        X_train = stack_sparse(df_train.drop(cols, axis=1), ohe.fit_transform(df_train[cols]))
+
+        if (df_test is None) & (df_val is None) & (out_encoder):
+            return X_train, ohe
+
+        X_val = stack_sparse(df_val.drop(cols, axis=1), ohe.transform(df_val[cols]))
+        X_test = stack_sparse(df_test.drop(cols, axis=1), ohe.transform(df_test[cols]))
+        return X_train, X_val, X_test
+
 
     ohe = OneHotEncoder(handle_unknown='ignore', sparse=False)
     df_ohe_train = pd.DataFrame(ohe.fit_transform(df_train[cols]))
@@ -137,6 +163,94 @@ def train_and_eval_model(model, X_train, y_train, X_test, df_pred):
 
 
 
+def benchmark_encoding(get_model, cols, X_train, y_train, X_test, y_test):
+    """
+    Compare one-hot encoding, sparse one-hot encoding and native categoricals on the same split
+    :param get_model: a function of the encoding name returning an unfitted model,
+    e.g. an XGBRegressor with enable_categorical=True for 'native'
+    :param cols: categorical columns
+    :param X_train: training features dataframe, the output from split_data
+    :param y_train: training label
+    :param X_test: test features dataframe
+    :param y_test: test label
+    :return: a df of the encoding, RMSLE on test data, size of the training matrix, and the encoding,
+    training and predicting time in seconds
+    """
+    rows = []
+    for encoding in ['ohe', 'sparse', 'native']:
+        tic = time.time()
+        X_train_enc, encoder = encode_data(cols, X_train, out_encoder=True
+                                           , sparse=encoding == 'sparse', native=encoding == 'native')
+        if encoding == 'native':
+            X_test_enc = apply_vocab(X_test, encoder)
+        elif encoding == 'sparse':
+            X_test_enc = stack_sparse(X_test.drop(cols, axis=1), encoder.transform(X_test[cols]))
+        else:
+            X_test_enc = pd.concat([X_test.drop(cols, axis=1)
+                                       , pd.DataFrame(encoder.transform(X_test[cols]), index=X_test.index)], axis=1)
+        encode_time = time.time() - tic
+
+        if encoding == 'sparse':
+            size = X_train_enc.data.nbytes + X_train_enc.indices.nbytes + X_train_enc.indptr.nbytes
+        else:
+            size = X_train_enc.memory_usage(deep=True).sum()
+
+        model = get_model(encoding)
+        tic = time.time()
+        model.fit(X_train_enc, y_train)
+        train_time = time.time() - tic
+
+        tic = time.time()
+        pred = model.predict(X_test_enc)
+        pred_time = time.time() - tic
+
+        pred = np.clip(pred, 0, None)
+        score = np.sqrt(np.mean(np.power(np.log1p(y_test) - np.log1p(pred), 2)))
+
+        rows.append([encoding, score, size / 1e6, encode_time, train_time, pred_time])
+
+    return pd.DataFrame(rows, columns=['ENCODING', 'RMSLE', 'MATRIX_MB', 'ENCODE_SECONDS'
+                                       , 'TRAIN_SECONDS', 'PREDICT_SECONDS']).round(4)
+
+
+def train_daily_model(df, model=None, model_path='model/model_daily.model', vocab_path='model/vocab_daily.vocab'):
+    """
+    Train the classifier of booked nights for optimise_daily and save it with the vocabulary of its
+    categorical columns, to the files get_daily_model loads by default
+    :param df: the nights to train on, the output of fs_daily with BOOKED, e.g. the calendars of the past months
+    :param model: an unfitted classifier, defaults to an XGBClassifier with native categoricals
+    :param model_path: path to save the trained classifier to
+    :param vocab_path: path to save the vocabulary to, empty if there is no categorical column
+    :return: the trained classifier and the vocabulary
+    """
+    # nights with a known label only
+    df_train = df[df.BOOKED.notna()]
+    X_train = df_train.drop(columns=DAILY_NON_FEATURES, errors='ignore')
+    y_train = df_train.BOOKED.astype(int)
+
+    # the same encoding as daily_model_api, see GlobalModel.encode_parts
+    cols = X_train.select_dtypes(include=['category', 'object']).columns.tolist()
+    vocab = build_vocab(X_train, cols)
+    X_train = apply_vocab(X_train, vocab)
+
+    if model is None:
+        from xgboost import XGBClassifier
+        model = XGBClassifier(n_estimators=200, max_depth=6, learning_rate=0.1, tree_method='hist'
+                              , enable_categorical=True)
+
+    tic = time.time()
+    model.fit(X_train, y_train)
+    toc = time.time()
+    print("Training time: {}".format(time.strftime("%H:%M:%S", time.gmtime(round(toc - tic, 2)))))
+
+    for path, obj in [(model_path, model), (vocab_path, vocab)]:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(obj, path)
+
+    return model, vocab
+
+
 def rmsle(predt, dtrain):
     ''' Root mean squared log error metric'''
     y = dtrain.get_label()
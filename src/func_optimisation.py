@@ -3,58 +3,329 @@
 import numpy as np
 import pandas as pd
 import time
+import threading
+import os
+import shutil
+import uuid
 from src.func_data_diagnosis import *
 from src.func_model_api import *
 import plotly.express as px
 
 
 
-def create_multiple_prices(df,range_max=2, num_prices=11):
+def create_multiple_prices(df,range_max=2, num_prices=11, compact=False):
     """
     Take the input dataframe and return multiple price points and add them in the PRICE column
     :param df: a dataframe with columns BASE_PRICE and other features.
     :param range_max: the end point of the price range.
     :param num_prices: the number of prices created from the range.
-    :return: a data frame with the same columns as the input plus PRICE
+    :param compact: if True, store str columns as categoricals before building the grid,
+    so each repeated value costs a small integer code instead of an object pointer.
+    :return: a data frame with the same columns as the input plus PRICE and PRICE_RATE,
+    ordered by PRICE_RATE and then by the input row order
     """
+    rates = np.linspace(1, range_max, num_prices, endpoint=True)
+    num_rows = df.shape[0]
 
-    df_prices = pd.DataFrame()
+    df_cp = df.reset_index(drop=True)
+    if compact:
+        cols_str = df_cp.select_dtypes(include='object').columns
+        df_cp = df_cp.astype({col: 'category' for col in cols_str})
 
-    df_cp = df.copy()
-    for i in np.linspace(1, range_max, num_prices, endpoint=True):
-        df_cp['PRICE'] = round(i * df_cp['BASE_PRICE'])
-        df_cp['PRICE_RATE'] = i
-        df_prices = df_prices.append(df_cp, ignore_index=True)
+    # build the whole listings x price rates grid in one take
+    df_prices = df_cp.take(np.tile(np.arange(num_rows), num_prices)).reset_index(drop=True)
+    price_rate = np.repeat(rates, num_rows)
+    df_prices['PRICE'] = np.round(price_rate * df_prices['BASE_PRICE'])
+    df_prices['PRICE_RATE'] = price_rate
 
     return df_prices
 
+class DemandCache:
+    """
+    Cache the predicted demand at listing, month and price points, so repeated optimisations
+    only score the points not seen before. A point is keyed by ID, YEAR_MONTH, a hash of the listing's
+    features and lag history, PRICE_RATE and PRICE (see demand_keys), and the cache holds the points of
+    one model version: it is cleared when the model files change.
+    Points expire ttl seconds after they are scored, and the least recently used are evicted above max_size.
+    With a path, the scored points are also saved to parquet files under path/<model version>,
+    and the points not in memory are looked up there before they are scored.
+    """
 
-def get_demand_curve(df):
+    def __init__(self, max_size=1000000, ttl=24 * 3600, path=None):
+        """
+        :param max_size: the maximum number of points kept in memory
+        :param ttl: the seconds a point is valid after it is scored
+        :param path: optional, the directory of the disk tier
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.version = None
+        self.df = self.empty()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def empty():
+        return pd.DataFrame({'BOOKED': pd.Series(dtype=float), 'SCORED_AT': pd.Series(dtype=float)
+                                , 'USED_AT': pd.Series(dtype=float)}, index=pd.Index([], dtype=np.uint64, name='KEY'))
+
+    def set_version(self, version):
+        """
+        Clear the cache and the disk tier of other versions if the model version changed
+        :param version: the model version, GlobalModel.version
+        :return: None
+        """
+        if version == self.version:
+            return
+
+        self.df = self.empty()
+        self.version = version
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+            for name in os.listdir(self.path):
+                if name != version:
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def get(self, keys, version):
+        """
+        Look up points in memory, and then on disk
+        :param keys: an array of point keys, the output of demand_keys
+        :param version: the model version, GlobalModel.version
+        :return: an array of BOOKED, nan for the points not cached
+        """
+        now = time.time()
+        with self.lock:
+            self.set_version(version)
+            # drop the expired points
+            self.df = self.df[self.df.SCORED_AT >= now - self.ttl]
+
+            pos = self.df.index.get_indexer(keys)
+            hit = pos >= 0
+            booked = np.full(len(keys), np.nan)
+            booked[hit] = self.df.BOOKED.to_numpy()[pos[hit]]
+
+            used_at = self.df.USED_AT.to_numpy().copy()
+            used_at[pos[hit]] = now
+            self.df['USED_AT'] = used_at
+
+        if (self.path is None) or hit.all():
+            return booked
+
+        # the disk tier, the points found are put back in memory
+        df_disk = self.read_disk(keys[~hit], version, now)
+        if not df_disk.empty:
+            pos = df_disk.index.get_indexer(keys)
+            found = pos >= 0
+            booked[found] = df_disk.BOOKED.to_numpy()[pos[found]]
+            self.put(df_disk.index.to_numpy(), df_disk.BOOKED.to_numpy(), version
+                     , scored_at=df_disk.SCORED_AT.to_numpy(), save=False)
+
+        return booked
+
+    def put(self, keys, booked, version, scored_at=None, save=True):
+        """
+        Add scored points, and save them to the disk tier
+        :param keys: an array of point keys, the output of demand_keys
+        :param booked: an array of BOOKED of the points
+        :param version: the model version the points are scored with
+        :param scored_at: optional, the time the points were scored, now if None
+        :param save: if False, do not save to the disk tier, e.g. for points read from it
+        :return: None
+        """
+        now = time.time()
+        df_new = pd.DataFrame({'BOOKED': np.asarray(booked, dtype=float)
+                                  , 'SCORED_AT': now if scored_at is None else scored_at, 'USED_AT': now}
+                              , index=pd.Index(keys, dtype=np.uint64, name='KEY'))
+        df_new = df_new[~df_new.index.duplicated(keep='last')]
+
+        with self.lock:
+            self.set_version(version)
+            self.df = pd.concat([self.df[~self.df.index.isin(df_new.index)], df_new])
+            # evict the least recently used points
+            if self.df.shape[0] > self.max_size:
+                self.df = self.df.nlargest(self.max_size, 'USED_AT')
+
+        if save and (self.path is not None):
+            path_version = os.path.join(self.path, version)
+            os.makedirs(path_version, exist_ok=True)
+            # a hidden temp file first, so the processes sharing the disk tier never read a half written file
+            name = f'part-{uuid.uuid4().hex}.parquet'
+            df_new.drop('USED_AT', axis=1).reset_index().to_parquet(os.path.join(path_version, '.' + name), index=False)
+            os.replace(os.path.join(path_version, '.' + name), os.path.join(path_version, name))
+
+            # remove the files of expired points, another process may have removed them already
+            for name in os.listdir(path_version):
+                file_path = os.path.join(path_version, name)
+                try:
+                    if os.path.getmtime(file_path) < now - self.ttl:
+                        os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+
+    def read_disk(self, keys, version, now):
+        """
+        Read points from the disk tier of a model version
+        :param keys: an array of point keys
+        :param version: the model version
+        :param now: the current time, points scored before now - ttl are expired
+        :return: a data frame of BOOKED and SCORED_AT indexed by KEY, the latest score of each point
+        """
+        path_version = os.path.join(self.path, version)
+        if (not os.path.isdir(path_version)) or (not os.listdir(path_version)):
+            return self.empty()
+
+        try:
+            df_disk = pd.read_parquet(path_version, filters=[('SCORED_AT', '>=', now - self.ttl)])
+        except FileNotFoundError:
+            # a file expired and removed by another process while reading, the points are scored again
+            return self.empty()
+        df_disk = df_disk[df_disk.KEY.isin(keys)]
+        df_disk = df_disk.sort_values('SCORED_AT').drop_duplicates('KEY', keep='last')
+
+        return df_disk.set_index('KEY')
+
+    def clear(self):
+        """
+        Clear the cache in memory and on disk
+        :return: None
+        """
+        with self.lock:
+            self.df = self.empty()
+            self.version = None
+            if self.path is not None:
+                shutil.rmtree(self.path, ignore_errors=True)
+
+
+# the resident demand cache shared by all calls in this process
+_demand_cache = None
+
+
+def get_demand_cache(max_size=1000000, ttl=24 * 3600, path=None):
     """
-    Take the input dataframe and return the output of demand curves(s)
-    :param df: a data frame with the columns same to the inputs for Model API, but with multiple prices.
-    :return: a data frame with columns ID, YEAR_MONTH, PRICE, BOOKED, REVENUE.
-    The higher the price, the lower the demand, while BOOKED can be the same for two consecutive prices
+    Return the resident DemandCache, created on the first call
+    :param max_size: the maximum number of points kept in memory
+    :param ttl: the seconds a point is valid after it is scored
+    :param path: optional, the directory of the disk tier
+    :return: a DemandCache
     """
-    # Model API, get predictions
+    global _demand_cache
 
-    df_cp = df.copy()
-    # extract PRICE_RATE
-    df_rate = df_cp[['ID', 'YEAR_MONTH', 'PRICE', 'PRICE_RATE']]
+    if (_demand_cache is None) or \
+            (_demand_cache.max_size, _demand_cache.ttl, _demand_cache.path) != (max_size, ttl, path):
+        _demand_cache = DemandCache(max_size, ttl, path)
+
+    return _demand_cache
+
+
+def demand_keys(df, prices, rates, df_history):
+    """
+    Take listings and their candidate prices and return the keys of the demand cache: a hash of
+    ID, YEAR_MONTH, the listing's features and lag history, PRICE_RATE and PRICE of each point.
+    PRICE is in the key since it is derived from BASE_PRICE, which is not a feature
+    :param df: a dataframe with the columns of price_model_api, one row per ID and YEAR_MONTH
+    :param prices: a 2d array with one row of prices per row of df
+    :param rates: a 2d array of the price rates of the prices
+    :param df_history: the lag history indexed by ID
+    :return: an array of uint64 keys, the prices of each input row in order
+    """
+    num_prices = prices.shape[1]
+
+    # the features of each listing, TXN_PRICE is replaced by the candidate prices
+    feature_hash = pd.util.hash_pandas_object(df[[col for col in API_COLS if col != 'TXN_PRICE']]
+                                              , index=False).to_numpy()
+
+    # the lag history of each listing, one hash per ID
+    df_hist = df_history[df_history.index.isin(df.ID)].reset_index().sort_values('ID', kind='mergesort')
+    hist_ids, starts = np.unique(df_hist.ID.to_numpy(), return_index=True)
+    hist_hash = pd.Series(np.zeros(len(hist_ids), dtype=np.uint64), index=hist_ids)
+    if len(hist_ids) > 0:
+        hist_hash[:] = np.bitwise_xor.reduceat(pd.util.hash_pandas_object(df_hist, index=False).to_numpy(), starts)
+
+    df_keys = pd.DataFrame({
+        'ID': np.repeat(df.ID.to_numpy(), num_prices)
+        , 'YEAR_MONTH': np.repeat(df.YEAR_MONTH.astype(str).to_numpy(), num_prices)
+        , 'FEATURE_HASH': np.repeat(feature_hash, num_prices)
+        , 'HISTORY_HASH': np.repeat(hist_hash.reindex(df.ID, fill_value=0).to_numpy(), num_prices)
+        , 'PRICE_RATE': np.ravel(rates)
+        , 'PRICE': np.ravel(prices)
+    })
+
+    return pd.util.hash_pandas_object(df_keys, index=False).to_numpy()
+
+
+def get_cached_demand(df, prices, rates, cache, model=None, df_history=None):
+    """
+    Take listings and their candidate prices and predict the demand at each price, serving the cached points
+    and scoring only the listings with points not in the cache
+    :param df: a dataframe with the columns of price_model_api, one row per ID and YEAR_MONTH
+    :param prices: a 2d array with one row of prices per row of df, nan for no price
+    :param rates: a 2d array of the price rates of the prices
+    :param cache: a DemandCache
+    :param model: a GlobalModel, defaults to the resident one
+    :param df_history: the lag history indexed by ID, defaults to the resident one
+    :return: an array of BOOKED, the prices of each input row in order, nan for no price
+    """
+    if model is None:
+        model = get_global_model()
+    if df_history is None:
+        df_history = get_history()
+    version = model.version
+
+    keys = demand_keys(df, prices, rates, df_history)
+    booked = cache.get(keys, version)
+
+    # listings with any point to score, the missing prices of listings with fewer prices are not scored
+    has_price = ~np.isnan(prices.ravel())
+    rows = (np.isnan(booked) & has_price).reshape(prices.shape).any(axis=1)
+    if rows.any():
+        df_pred = price_model_api(df[rows], prices[rows], model=model, df_history=df_history)
+        booked = booked.reshape(prices.shape)
+        booked[rows] = df_pred.BOOKED.to_numpy().reshape(-1, prices.shape[1])
+        booked = booked.ravel()
+
+        scored = np.repeat(rows, prices.shape[1]) & has_price
+        cache.put(keys[scored], booked[scored], version)
+
+    return booked
 
-    # change col name, todo: rm after changed model
-    df_cp = df_cp.rename(columns={'PRICE': 'TXN_PRICE'})
 
-    # drop PRICE_RATE for prediction
-    df_cp = df_cp.drop('PRICE_RATE', axis=1)
+def get_demand_curve(df, model=None, df_history=None, cache=None):
+    """
+    Take the input dataframe and return the output of demand curves(s)
+    :param df: a data frame with the columns same to the inputs for Model API, but with multiple prices,
+    the output of create_multiple_prices
+    :param model: a GlobalModel, defaults to the resident one
+    :param df_history: the lag history indexed by ID, defaults to the resident one
+    :param cache: optional, a DemandCache, only the points not in it are scored, see get_cached_demand
+    :return: a data frame with columns ID, YEAR_MONTH, PRICE, BOOKED, PRICE_RATE, REVENUE.
+    The higher the price, the lower the demand, while BOOKED can be the same for two consecutive prices
+    """
+    keys = ['ID', 'YEAR_MONTH']
 
-    # get prediction
-    df_pred = global_model_api(df_cp)
-    # change col name, todo: rm after changed model
-    df_pred = df_pred.rename(columns={'TXN_PRICE': 'PRICE'})
+    # one row per listing and month, and its candidate prices and rates in columns
+    df_cp = df.copy()
+    df_cp['POINT'] = df_cp.groupby(keys).cumcount()
+    df_base = df_cp[df_cp.POINT == 0].drop(['PRICE', 'PRICE_RATE', 'POINT'], axis=1)
+    idx = pd.MultiIndex.from_frame(df_base[keys])
+    prices = df_cp.pivot(index=keys, columns='POINT', values='PRICE').reindex(idx)
+    rates = df_cp.pivot(index=keys, columns='POINT', values='PRICE_RATE').reindex(idx)
+
+    # Model API, get predictions, the features are computed once per listing
+    if cache is None:
+        df_pred = price_model_api(df_base, prices.to_numpy(), model=model, df_history=df_history)
+    else:
+        booked = get_cached_demand(df_base, prices.to_numpy(), rates.to_numpy(), cache, model, df_history)
+        df_pred = pd.DataFrame({
+            'ID': np.repeat(df_base.ID.to_numpy(), prices.shape[1])
+            , 'YEAR_MONTH': np.repeat(df_base.YEAR_MONTH.to_numpy(), prices.shape[1])
+            , 'PRICE': prices.to_numpy().ravel()
+            , 'BOOKED': np.nan_to_num(booked).astype(int)
+        })
+
+    # put back PRICE_RATE, and drop the missing points of listings with fewer prices
+    df_pred['PRICE_RATE'] = rates.to_numpy().ravel()
+    df_pred = df_pred[df_pred.PRICE.notna()]
 
-    # put back PRICE_RATE
-    df_pred = df_pred.merge(df_rate, on = ['ID','YEAR_MONTH','PRICE'])
     # Monotonic transformation
     df_demand_curve = transform_monotonic(df_pred)
 
@@ -71,21 +342,17 @@ def transform_monotonic(df):
     """
     Take the df and return the monotonic demand curve(s)
     :param df: a data frame with columns ID, YEAR_MONTH, PRICE, BOOKED.
-    :return: a data frame with the same columns as the input. The higher the PRICE is for the same ID,
-    the lower the BOOKED, while BOOKED can be the same for two consecutive PRICEs
+    :return: a data frame with the same columns as the input, sorted by ID, YEAR_MONTH and PRICE.
+    The higher the PRICE is for the same ID and YEAR_MONTH, the lower the BOOKED,
+    while BOOKED can be the same for two consecutive PRICEs
     """
 
-    # make a copy
-    df_cp = df.copy()
+    # sort once, so each demand curve is a contiguous block ordered by price
+    # a stable sort keeps the input order for equal prices
+    df_monotonic = df.sort_values(by=['ID', 'YEAR_MONTH', 'PRICE'], kind='mergesort').reset_index(drop=True)
 
-    # initialise output df
-    df_monotonic = pd.DataFrame()
-
-    for id in df_cp.ID.unique():
-        df_id = df_cp[df_cp.ID == id].set_index('PRICE')
-        df_id['BOOKED'] = np.minimum.accumulate(df_id['BOOKED'])
-        df_id = df_id.reset_index()
-        df_monotonic = df_monotonic.append(df_id, ignore_index=True)
+    # running minimum of BOOKED along each curve
+    df_monotonic['BOOKED'] = df_monotonic.groupby(['ID', 'YEAR_MONTH'], sort=False)['BOOKED'].cummin()
 
     return df_monotonic
 
@@ -93,27 +360,380 @@ def create_objective_col(df_demand_curve, cost = 0):
     """
     Take the input df_demand_curve and return the new objective column
     :param df_demand_curve: a data frame, the output from get_demand_curve
+    :param cost: the amount added to the revenue per night booked, a scalar,
+    or a Series indexed by ID for the variable costs of each listing, 0 for listings not in it
     :return: a data frame with the same columns as df_demand_curve, but with OBJ column
     """
+    if isinstance(cost, pd.Series):
+        cost = df_demand_curve.ID.map(cost).fillna(0)
+
     df_demand_curve['OBJ'] = round(df_demand_curve['REVENUE'] + df_demand_curve['BOOKED'] * cost)
 
     return df_demand_curve
 
 
+def grid_starts(ids, year_month, price):
+    """
+    Take a grid of prices and return where each ID and YEAR_MONTH starts
+    :param ids: an array of ID
+    :param year_month: an array of YEAR_MONTH
+    :param price: an array of PRICE
+    :return: an array of the first row of each ID and YEAR_MONTH, and if the grid is sorted
+    by ID, YEAR_MONTH and PRICE, the starts are only valid for a sorted grid
+    """
+    new = np.ones(len(ids), dtype=bool)
+    new[1:] = (ids[1:] != ids[:-1]) | (year_month[1:] != year_month[:-1])
+    starts = np.flatnonzero(new)
+
+    # the keys increase from one ID and YEAR_MONTH to the next, and the prices within each
+    ids_s, year_month_s = ids[starts], year_month[starts]
+    keys_sorted = ((ids_s[1:] > ids_s[:-1]) | ((ids_s[1:] == ids_s[:-1]) & (year_month_s[1:] > year_month_s[:-1]))).all()
+    prices_sorted = (price[1:][~new[1:]] >= price[:-1][~new[1:]]).all()
+
+    return starts, keys_sorted & prices_sorted
+
+
+def dense_grid(df, cols):
+    """
+    Put a grid of prices into dense arrays of listing-months x prices, the prices of each listing-month in ascending order
+    :param df: a data frame with columns ID, YEAR_MONTH, PRICE and cols.
+    A grid sorted by ID, YEAR_MONTH and PRICE, as from get_demand_curve, is not sorted again
+    :param cols: the columns to put into arrays
+    :return: a 2d array of the row positions in df, -1 for the padding of listing-months with fewer prices,
+    and a dict of column and its 2d array, nan for the padding. The listing-months are sorted by ID and YEAR_MONTH
+    """
+    ids = df.ID.to_numpy()
+    year_month = df.YEAR_MONTH.to_numpy()
+    price = df.PRICE.to_numpy()
+
+    starts, is_sorted = grid_starts(ids, year_month, price)
+    order = np.arange(len(ids))
+    if not is_sorted:
+        # a stable sort on integer codes of the keys
+        id_codes = pd.factorize(ids, sort=True)[0]
+        year_month_codes = pd.factorize(year_month, sort=True)[0]
+        order = np.lexsort((price, year_month_codes, id_codes))
+        starts, is_sorted = grid_starts(id_codes[order], year_month_codes[order], price[order])
+
+    counts = np.diff(np.append(starts, len(order)))
+    if (counts == counts[0]).all():
+        # the same number of prices for all listing-months, a reshape
+        pos = order.reshape(-1, counts[0])
+    else:
+        # pad the listing-months with fewer prices
+        group = np.repeat(np.arange(len(starts)), counts)
+        pos = np.full((len(starts), counts.max()), -1)
+        pos[group, np.arange(len(order)) - starts[group]] = order
+
+    grids = {col: np.where(pos >= 0, df[col].to_numpy(dtype=float)[pos], np.nan) for col in cols}
+
+    return pos, grids
+
+
 def optimise_brute_force(df):
     """
     Take the input df (output from get_demand_curve) and return the subset of df, where each row in the subset
-    represents the best prices
-    :param df: a data frame with columns, ID, YEAR_MONTH, PRICE, BOOKED, OBJ
-    :return: a subset data frame with the same columns
+    represents the best prices. The grid is put into a dense array of listing-months x prices
+    and the best price of each listing-month is one argmax, the lowest price if several have the max OBJ
+    :param df: a data frame with columns, ID, YEAR_MONTH, PRICE, BOOKED, OBJ.
+    A grid sorted by ID, YEAR_MONTH and PRICE, as from get_demand_curve, is not sorted again
+    :return: a subset data frame with the same columns, one row per ID and YEAR_MONTH, sorted by ID and YEAR_MONTH
     """
+    if df.empty:
+        return df
+
+    pos, grids = dense_grid(df, ['OBJ'])
+
+    # missing OBJ and the padding are never the best
+    obj = np.nan_to_num(grids['OBJ'], nan=-np.inf)
 
-    # get the index with max OBJ
-    idx = df.groupby(['ID'])['OBJ'].transform(max) == df.OBJ
-    df_best = df[idx]
+    # argmax returns the first max, i.e. the lowest price
+    best = obj.argmax(axis=1)
+    df_best = df.iloc[pos[np.arange(pos.shape[0]), best]]
 
     return df_best
 
+
+def optimise_portfolio(df, min_booked=None, last_price=None, max_change=None, neighbourhood=None, price_floor=None):
+    """
+    Take the input df (output from create_objective_col) and return the best prices of a portfolio of listings
+    under joint constraints:
+    1) the price of a listing is at least the floor of its neighbourhood,
+    2) the price of a listing changes at most max_change from its last price,
+    3) the total nights booked of the listings in each YEAR_MONTH is at least min_booked.
+    1) and 2) remove prices from each demand curve, a listing-month without any price left keeps the prices
+    closest to them. 3) is a multiple-choice knapsack, solved by its Lagrangian relaxation: each listing-month takes
+    the price with the max OBJ + LAMBDA * BOOKED, with the smallest LAMBDA of each YEAR_MONTH meeting min_booked,
+    found by bisection on the dense arrays of all listings at once
+    :param df: a data frame with columns ID, YEAR_MONTH, PRICE, BOOKED, OBJ
+    :param min_booked: optional, the minimum total nights booked in each YEAR_MONTH,
+    a scalar or a Series indexed by YEAR_MONTH
+    :param last_price: optional, a Series of the last price of each listing indexed by ID,
+    e.g. the last TXN_PRICE of the lag history
+    :param max_change: optional, the maximum change from the last price as a rate, e.g. 0.2
+    :param neighbourhood: optional, a Series of the neighbourhood of each listing indexed by ID
+    :param price_floor: optional, a dict of neighbourhood and its minimum price
+    :return: a subset data frame with the same columns, one row per ID and YEAR_MONTH, sorted by ID and YEAR_MONTH.
+    With min_booked, plus MIN_BOOKED_MET, False for the months where it cannot be met
+    """
+    if df.empty:
+        return df
+
+    # how far each price is from meeting the price constraints
+    price = df.PRICE.to_numpy(dtype=float)
+    violation = np.zeros(len(price))
+    if (neighbourhood is not None) and (price_floor is not None):
+        floor = df.ID.map(neighbourhood).map(price_floor).fillna(0).to_numpy(dtype=float)
+        violation += np.clip(floor - price, 0, None)
+    if (last_price is not None) and (max_change is not None):
+        last = df.ID.map(last_price).to_numpy(dtype=float)
+        # no constraint for listings without a last price
+        violation += np.nan_to_num(np.clip(np.abs(price - last) - max_change * last, 0, None))
+
+    pos, grids = dense_grid(df, ['OBJ', 'BOOKED'])
+    rows = np.arange(pos.shape[0])
+
+    # the prices meeting the price constraints, or else the closest to them
+    violation = np.where(pos >= 0, violation[pos], np.inf)
+    allowed = violation == violation.min(axis=1, keepdims=True)
+    obj = np.where(allowed, np.nan_to_num(grids['OBJ'], nan=-np.inf), -np.inf)
+    booked = np.where(allowed, np.nan_to_num(grids['BOOKED']), 0)
+
+    lam = np.zeros(pos.shape[0])
+    if min_booked is not None:
+        month_codes, months = pd.factorize(df.YEAR_MONTH.to_numpy()[pos[:, 0]])
+        if isinstance(min_booked, pd.Series):
+            target = min_booked.reindex(months).fillna(0).to_numpy(dtype=float)
+        else:
+            target = np.full(len(months), min_booked, dtype=float)
+
+        def total_booked(lam_month):
+            best = (obj + lam_month[month_codes][:, None] * booked).argmax(axis=1)
+            return np.bincount(month_codes, booked[rows, best], minlength=len(months))
+
+        # above the range of OBJ, every listing takes the price with the most nights booked
+        obj_finite = obj[np.isfinite(obj)]
+        lo = np.zeros(len(months))
+        hi = np.full(len(months), obj_finite.max() - obj_finite.min() + 1 if obj_finite.size else 1)
+        met = total_booked(lo) >= target
+
+        # months where even the most nights booked are below min_booked, they take the most nights booked
+        unmet = total_booked(hi) < target
+        if unmet.any():
+            log_time('min_booked cannot be met in {}'.format(list(months[unmet])))
+
+        # bisection of the smallest LAMBDA of each YEAR_MONTH meeting min_booked
+        for _ in range(50):
+            mid = (lo + hi) / 2
+            mid_met = total_booked(mid) >= target
+            hi = np.where(mid_met, mid, hi)
+            lo = np.where(mid_met, lo, mid)
+
+        lam = np.where(met, 0, hi)[month_codes]
+
+    # argmax returns the first max, i.e. the lowest price
+    best = (obj + lam[:, None] * booked).argmax(axis=1)
+    df_best = df.iloc[pos[rows, best]]
+
+    if min_booked is not None:
+        df_best = df_best.assign(MIN_BOOKED_MET=~unmet[month_codes])
+
+    return df_best
+
+
+def optimise_adaptive(df, range_max=2, num_prices=11, num_rounds=4, cost=0, model=None, df_history=None, cache=None):
+    """
+    Take the input df and return the best prices, searching each listing's demand curve adaptively instead of
+    scoring a fine grid: a coarse grid of price rates first, then rounds of successive halving, each scoring
+    the price rates half a step below and above the best rate so far, with the step halved every round.
+    The features are encoded once and each round is one batch of all listings. After the rounds,
+    the resolution is the same as a grid of (num_prices - 1) * 2 ** num_rounds + 1 prices,
+    at num_prices + 2 * num_rounds prices per listing. With a cache, each round only scores the points
+    not in it, and the features are not encoded if all the points are cached
+    :param df: a data frame with the columns same to the inputs for Model API and BASE_PRICE, one row per ID and YEAR_MONTH
+    :param range_max: the end point of the price range, see create_multiple_prices
+    :param num_prices: the number of prices of the coarse grid, at least 2
+    :param num_rounds: the number of refinement rounds
+    :param cost: the cost of a night booked, see create_objective_col
+    :param model: a GlobalModel, defaults to the resident one
+    :param df_history: the lag history indexed by ID, defaults to the resident one
+    :param cache: optional, a DemandCache shared with get_demand_curve, see get_cached_demand
+    :return: a data frame with columns ID, YEAR_MONTH, PRICE, BOOKED, PRICE_RATE, REVENUE, OBJ,
+    one row per ID and YEAR_MONTH, sorted by ID and YEAR_MONTH
+    """
+    # input validation
+    check_dataframe(df, [col for col in API_COLS if col != 'TXN_PRICE'] + ['BASE_PRICE'])
+    if num_prices < 2:
+        raise ValueError(f'num_prices must be at least 2 for the coarse grid, got {num_prices}')
+
+    if model is None:
+        model = get_global_model()
+    if df_history is None:
+        df_history = get_history()
+
+    # feature engineering and encoding, once per listing and only when a point is scored
+    df_cp = df.reset_index(drop=True)
+    df_cp['TXN_PRICE'] = df_cp.BASE_PRICE
+    encoded = None
+
+    num_rows = df_cp.shape[0]
+    base_price = df_cp.BASE_PRICE.to_numpy(dtype=float)[:, None]
+    rates = np.broadcast_to(np.linspace(1, range_max, num_prices, endpoint=True), (num_rows, num_prices))
+    step = (range_max - 1) / (num_prices - 1)
+
+    points = []
+    for round_ in range(num_rounds + 1):
+        # score the new rates of all listings not in the cache in one batch
+        prices = np.round(rates * base_price)
+        rows = np.repeat(np.arange(num_rows), rates.shape[1])
+        if cache is None:
+            booked = np.full(prices.size, np.nan)
+        else:
+            keys = demand_keys(df_cp, prices, rates, df_history)
+            booked = cache.get(keys, model.version)
+
+        missing = np.isnan(booked)
+        if missing.any():
+            if encoded is None:
+                encoded = encode_listings(df_cp, model, df_history)
+            _, df_num, ohe_cols = encoded
+            booked[missing] = score_rows(model, df_num, ohe_cols, rows[missing], prices.ravel()[missing])
+            if cache is not None:
+                cache.put(keys[missing], booked[missing], model.version)
+
+        points.append(pd.DataFrame({
+            'ID': df_cp.ID.to_numpy()[rows]
+            , 'YEAR_MONTH': df_cp.YEAR_MONTH.to_numpy()[rows]
+            , 'PRICE': prices.ravel()
+            , 'BOOKED': booked.astype(int)
+            , 'PRICE_RATE': rates.ravel()
+            , 'ROW': rows
+        }))
+
+        # the monotonic demand curves of all the points scored so far, and the best point of each listing
+        df_points = transform_monotonic(pd.concat(points, ignore_index=True).drop_duplicates(['ROW', 'PRICE']))
+        df_points['REVENUE'] = np.round(df_points.PRICE * df_points.BOOKED)
+        df_best = optimise_brute_force(create_objective_col(df_points, cost))
+
+        # the rates half a step around the best rates
+        step = step / 2
+        best_rate = np.empty(num_rows)
+        best_rate[df_best.ROW.to_numpy()] = df_best.PRICE_RATE.to_numpy()
+        rates = np.clip(best_rate[:, None] + np.array([-step, step]), 1, range_max)
+
+    return df_best[['ID', 'YEAR_MONTH', 'PRICE', 'BOOKED', 'PRICE_RATE', 'REVENUE', 'OBJ']]
+
+
+def benchmark_adaptive(df, num_prices=100, coarse_prices=11, num_rounds=4, range_max=2, cost=0
+                       , model=None, df_history=None):
+    """
+    Compare the fine grid search and the adaptive search on the same listings. The best prices of both are
+    scored again with the raw model, so the revenues are compared on the same demand and not on the
+    monotonic curves each search fitted to its own points
+    :param df: a data frame with the columns same to the inputs for Model API and BASE_PRICE, one row per ID and YEAR_MONTH
+    :param num_prices: the number of prices of the fine grid
+    :param coarse_prices: the number of prices of the coarse grid of the adaptive search
+    :param num_rounds: the number of refinement rounds of the adaptive search
+    :param range_max: the end point of the price range, see create_multiple_prices
+    :param cost: the cost of a night booked, see create_objective_col
+    :param model: a GlobalModel, defaults to the resident one
+    :param df_history: the lag history indexed by ID, defaults to the resident one
+    :return: a df of the method, the number of prices scored by the model, seconds, total revenue,
+    the revenue gap to the grid, the mean best price and the mean absolute difference to the best prices of the grid
+    """
+    if model is None:
+        model = get_global_model()
+    if df_history is None:
+        df_history = get_history()
+
+    keys = ['ID', 'YEAR_MONTH']
+    num_rows = df.shape[0]
+
+    tic = time.time()
+    df_grid = create_objective_col(get_demand_curve(create_multiple_prices(df, range_max, num_prices)
+                                                    , model, df_history), cost)
+    df_grid = optimise_brute_force(df_grid)
+    grid_time = time.time() - tic
+
+    tic = time.time()
+    df_adaptive = optimise_adaptive(df, range_max, coarse_prices, num_rounds, cost, model, df_history)
+    adaptive_time = time.time() - tic
+
+    methods = [(f'grid_{num_prices}', df_grid, num_rows * num_prices, grid_time)
+        , ('adaptive', df_adaptive, num_rows * (coarse_prices + 2 * num_rounds), adaptive_time)]
+
+    rows = []
+    for method, df_best, num_calls, seconds in methods:
+        df_best = df[keys].merge(df_best[keys + ['PRICE']], on=keys, how='left')
+        df_demand = price_model_api(df, df_best.PRICE.to_numpy()[:, None], model=model, df_history=df_history)
+        revenue = (df_demand.PRICE * df_demand.BOOKED).sum()
+        rows.append([method, num_calls, seconds, revenue, df_best.PRICE])
+
+    grid_revenue, grid_price = rows[0][3], rows[0][4]
+    rows = [[method, num_calls, seconds, revenue, 1 - revenue / grid_revenue
+                , price.mean(), (price - grid_price).abs().mean()]
+            for method, num_calls, seconds, revenue, price in rows]
+
+    return pd.DataFrame(rows, columns=['METHOD', 'MODEL_CALLS', 'SECONDS', 'REVENUE', 'REVENUE_GAP'
+                                       , 'MEAN_PRICE', 'PRICE_DIFF']).round(4)
+
+
+def optimise_daily(df, range_min=1, range_max=2, num_prices=11, cost=0, weekly=False, model=None, chunksize=100000):
+    """
+    Take the nights of listings (output from fs_daily) and return the best price of each night for the expected revenue,
+    the probability of being booked x price. The probabilities of all nights x price rates are predicted in one
+    call, made monotonic in price, and each night, or each listing-week if weekly, takes one argmax
+    :param df: a data frame of the available nights to price, e.g. the next 30 to 90 nights of the latest calendar,
+    the output of fs_daily
+    :param range_min: the start point of the price range, as a rate of BASE_PRICE
+    :param range_max: the end point of the price range, as a rate of BASE_PRICE
+    :param num_prices: the number of prices created from the range
+    :param cost: the amount added to the revenue per night booked, a scalar or a Series indexed by ID
+    :param weekly: if True, one price rate for all the nights of a listing in a week (Monday to Sunday)
+    :param model: a GlobalModel of a classifier, defaults to the resident one from get_daily_model
+    :param chunksize: the number of nights x prices predicted at a time
+    :return: a data frame with columns ID, DATE, BASE_PRICE, PRICE_RATE, PRICE, BOOKED_PROB, REVENUE, OBJ,
+    one row per night in the order of df, REVENUE and OBJ are expected values
+    """
+    df_cp = df.reset_index(drop=True)
+    rates = np.linspace(range_min, range_max, num_prices, endpoint=True)
+    base_price = df_cp.BASE_PRICE.to_numpy(dtype=np.float32)[:, None]
+    prices = np.round(rates * base_price).astype(np.float32)
+
+    # the probability of each night at each price, the higher the price, the lower the probability
+    prob = daily_model_api(df_cp, prices, chunksize, model=model)
+    prob = np.minimum.accumulate(prob, axis=1)
+
+    if isinstance(cost, pd.Series):
+        cost = df_cp.ID.map(cost).fillna(0).to_numpy(dtype=np.float32)[:, None]
+    obj = prob * (prices + cost)
+
+    rows = np.arange(df_cp.shape[0])
+    if weekly:
+        # sum each listing-week at each rate, and give its best rate to all its nights
+        dates = pd.to_datetime(df_cp.DATE.astype(str), format='%Y-%m-%d')
+        week = (dates - pd.to_timedelta(dates.dt.dayofweek, unit='D')).to_numpy()
+        group = pd.MultiIndex.from_arrays([df_cp.ID.to_numpy(), week]).factorize()[0]
+        obj_week = pd.DataFrame(obj).groupby(group).sum().to_numpy()
+        # argmax returns the first max, i.e. the lowest price
+        best = obj_week.argmax(axis=1)[group]
+    else:
+        best = obj.argmax(axis=1)
+
+    df_best = pd.DataFrame({
+        'ID': df_cp.ID.to_numpy()
+        , 'DATE': df_cp.DATE.to_numpy()
+        , 'BASE_PRICE': df_cp.BASE_PRICE.to_numpy(dtype=float)
+        , 'PRICE_RATE': rates[best]
+        , 'PRICE': prices[rows, best].astype(float)
+        , 'BOOKED_PROB': prob[rows, best].astype(float)
+    })
+    df_best['REVENUE'] = np.round(df_best.BOOKED_PROB * df_best.PRICE, 2)
+    df_best['OBJ'] = np.round(obj[rows, best].astype(float), 2)
+
+    return df_best
+
+
 def diagnose_output(df_optimised):
     """
     Take the two input dfs and return a set of diagnosis
@@ -1,12 +1,20 @@
 # Here saves the functions for optimiser api
 from src.func_optimisation import *
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import os
 
 
-def optimiser_api(df, op_time=False):
+def optimiser_api(df, op_time=False, cache=None, adaptive=False, model=None, df_history=None):
     """
     A wrapper func. Take a dataframe with feature columns and return a dataframe with optimised price
     :param df: a dataframe with feature columns including price
-    :return: a dataframe with the same columns plus .....
+    :param cache: a DemandCache, defaults to the resident one from get_demand_cache, used by both searches
+    :param adaptive: if True, search the prices with optimise_adaptive instead of a grid
+    :param model: a GlobalModel, defaults to the resident one
+    :param df_history: the lag history indexed by ID, defaults to the resident one
+    :return: a dataframe with the same rows and columns plus PRICE, BOOKED, PRICE_RATE, REVENUE and OBJ
+    of the best price of each ID and YEAR_MONTH, the same with or without adaptive
     """
     # track the time used
     tic = time.time()
@@ -44,18 +52,169 @@ def optimiser_api(df, op_time=False):
     # ensure data type if needed
     # impute if needed
 
-    # add prices
-    df_prices = create_multiple_prices(df_cp)
+    # the points scored by earlier calls are served from the cache
+    if cache is None:
+        cache = get_demand_cache()
 
-    # get demand curve
-    df_demand = get_demand_curve(df_prices)
+    if adaptive:
+        # a coarse grid refined around the best prices, no extra cost for nights booked
+        df_best = optimise_adaptive(df_cp, model=model, df_history=df_history, cache=cache)
+    else:
+        # add prices
+        df_prices = create_multiple_prices(df_cp)
+
+        # get demand curve
+        df_demand = get_demand_curve(df_prices, model=model, df_history=df_history, cache=cache)
+
+        # create obj column
+        # no extra cost for nights booked
+        df_demand = create_objective_col(df_demand)
+
+        # get the best prices
+        df_best = optimise_brute_force(df_demand)
+
+    # put the best prices back on the input rows, so both searches return the same columns
+    keys = ['ID', 'YEAR_MONTH']
+    best_cols = ['PRICE', 'BOOKED', 'PRICE_RATE', 'REVENUE', 'OBJ']
+    df_best = df_cp.drop(columns=best_cols, errors='ignore').merge(df_best[keys + best_cols], on=keys, how='left')
+
+    toc = time.time()
+    total_time = round(toc - tic)
+
+    if op_time:
+        return df_best, total_time
+    else:
+        return df_best
+
+
+def init_optimiser_worker(model_path, ohe_path, history_path, sparse=False, cache_args=None):
+    """
+    Load the model, the lag history and the demand cache once in a worker process, they stay resident
+    for all its shards and all the calls of sharded_optimiser_api. The model runs one thread,
+    the process pool runs the shards in parallel
+    :param model_path: path of the trained model
+    :param ohe_path: path of the fitted one-hot encoder
+    :param history_path: path of the history parquet file
+    :param sparse: if the model is trained on sparse features, see get_global_model
+    :param cache_args: the max_size, ttl and path of the demand cache, see get_demand_cache,
+    the workers share the disk tier under path
+    :return: None
+    """
+    get_global_model(model_path, ohe_path, sparse, n_jobs=1)
+    get_history(history_path)
+    get_demand_cache(*cache_args)
+
+
+def optimise_shard(df, model_path, ohe_path, history_path, adaptive=False, sparse=False, cache_args=None):
+    """
+    Run optimiser_api on a shard of listings with the resident model, lag history and demand cache of the process.
+    The model and the history are reloaded if their files changed since the worker started
+    :param df: a shard of the input of optimiser_api
+    :param model_path: path of the trained model
+    :param ohe_path: path of the fitted one-hot encoder
+    :param history_path: path of the history parquet file
+    :param adaptive: see optimiser_api
+    :param sparse: if the model is trained on sparse features, see get_global_model
+    :param cache_args: the max_size, ttl and path of the demand cache, see init_optimiser_worker
+    :return: the output of optimiser_api
+    """
+    model = get_global_model(model_path, ohe_path, sparse, n_jobs=1)
+    df_history = get_history(history_path)
+    cache = get_demand_cache(*cache_args)
+
+    return optimiser_api(df, cache=cache, adaptive=adaptive, model=model, df_history=df_history)
 
-    # create obj column
-    # no extra cost for nights booked
-    df_demand = create_objective_col(df_demand)
 
-    # get the best prices
-    df_best = optimise_brute_force(df_demand)
+# the process pool shared by all calls in this process, and the settings its workers were started with
+_optimiser_pool = {'executor': None, 'args': None}
+
+
+def get_optimiser_pool(num_workers, init_args):
+    """
+    Return the resident process pool, starting it on the first call and restarting it if the number of
+    workers or the worker settings changed, so the workers load the model and the history once for many calls
+    :param num_workers: the number of processes
+    :param init_args: the arguments of init_optimiser_worker
+    :return: a ProcessPoolExecutor
+    """
+    if (_optimiser_pool['executor'] is None) or (_optimiser_pool['args'] != (num_workers, init_args)):
+        shutdown_optimiser_pool()
+        _optimiser_pool['executor'] = ProcessPoolExecutor(max_workers=num_workers, initializer=init_optimiser_worker
+                                                          , initargs=init_args)
+        _optimiser_pool['args'] = (num_workers, init_args)
+
+    return _optimiser_pool['executor']
+
+
+def shutdown_optimiser_pool():
+    """
+    Stop the workers of the resident process pool, if any
+    :return: None
+    """
+    if _optimiser_pool['executor'] is not None:
+        _optimiser_pool['executor'].shutdown()
+    _optimiser_pool['executor'] = None
+    _optimiser_pool['args'] = None
+
+
+def sharded_optimiser_api(df, num_workers=None, num_shards=None, adaptive=False, op_time=False
+                          , model_path='model/model_base.model', ohe_path='model/ohe_base.ohe'
+                          , history_path='data/history.parquet', sparse=False, cache=None
+                          , cache_path='data/demand_cache'):
+    """
+    Take a dataframe with feature columns and return a dataframe with optimised price, the same as optimiser_api,
+    with the listings split into shards by ID and the shards optimised in parallel in a process pool.
+    The pool is kept between calls (get_optimiser_pool), and each worker loads the model, the lag history and
+    a demand cache once (init_optimiser_worker). The worker caches share the disk tier of the cache,
+    so the points scored by any worker are served to all of them in the next calls
+    :param df: a dataframe with feature columns including price, see optimiser_api
+    :param num_workers: the number of processes, one per cpu if None, 1 to run in this process
+    :param num_shards: the number of shards, one per worker if None, more shards balance uneven shards
+    :param adaptive: see optimiser_api
+    :param model_path: path of the trained model
+    :param ohe_path: path of the fitted one-hot encoder
+    :param history_path: path of the history parquet file
+    :param sparse: if the model is trained on sparse features, see get_global_model
+    :param cache: a DemandCache, used as is in this process, and its settings and disk tier by the workers.
+    Defaults to the resident one with its disk tier under cache_path
+    :param cache_path: the directory of the disk tier of the default cache
+    :return: the output of optimiser_api, one row per ID and YEAR_MONTH sorted by ID and YEAR_MONTH
+    """
+    # track the time used
+    tic = time.time()
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if num_shards is None:
+        num_shards = num_workers
+    if cache is None:
+        cache = get_demand_cache(path=cache_path)
+    cache_args = (cache.max_size, cache.ttl, cache.path)
+
+    # build the history once here, not in every worker
+    if not os.path.exists(history_path):
+        get_history(history_path)
+
+    # shards of whole listings, consecutive ranges of sorted IDs
+    ids = np.sort(df.ID.unique())
+    shards = [df[df.ID.isin(shard_ids)] for shard_ids in np.array_split(ids, num_shards) if len(shard_ids) > 0]
+    num_workers = max(min(num_workers, len(shards)), 1)
+
+    if num_workers == 1:
+        # all the shards at once, with the threads of the model
+        results = [optimiser_api(df, cache=cache, adaptive=adaptive, model=get_global_model(model_path, ohe_path, sparse)
+                                 , df_history=get_history(history_path))]
+    else:
+        executor = get_optimiser_pool(num_workers, (model_path, ohe_path, history_path, sparse, cache_args))
+        args = [(shard, model_path, ohe_path, history_path, adaptive, sparse, cache_args) for shard in shards]
+        try:
+            results = list(executor.map(optimise_shard, *zip(*args)))
+        except BrokenProcessPool:
+            # a worker died, start a new pool on the next call
+            shutdown_optimiser_pool()
+            raise
+
+    df_best = pd.concat(results).sort_values(['ID', 'YEAR_MONTH'], kind='mergesort').reset_index(drop=True)
 
     toc = time.time()
     total_time = round(toc - tic)
@@ -63,4 +222,4 @@ def optimiser_api(df, op_time=False):
     if op_time:
         return df_best, total_time
     else:
-        return df_best
\ No newline at end of file
+        return df_best